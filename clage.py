@@ -1,36 +1,195 @@
 import re
 import os
+import sys
 import math
 import pygame
 import ast
-
-_state = {
-    "stage_defined": False,
-    "block_stack": [],
-    "sprites": {},
-    "sprite_order": [],
-    "logical": {"xmin": -240, "xmax": 240, "ymin": -180, "ymax": 180},
-    "fps": 30,
-    "screen": None,
-    "clock": None,
-    "window_size": (960, 720),
-    "images_cache": {},
-    "foreign_depth": 0,
-    "running": True,
-
-    "pending_to_clambon": [],
-    "drain_cursor": 0,
-    "max_drain_per_frame": 64,
-
-    "clone_scripts": {},
-    "clone_counter": {},
-    "clone_capture": None,
-
-    "ppu": 2,
-
-    "globals": {},
+import operator
+import functools
+import collections
+import time
+import concurrent.futures
+import hashlib
+import mmap
+import struct
+import threading
+import atexit
+import json
+import csv
+
+# インタープリタの 状態 1つ分。Worldごとに 1つ 持ち、モジュールの 関数は 既定の ものを 使う
+def _new_state():
+    return {
+        "stage_defined": False,
+        "block_stack": [],
+        "sprites": {},
+        # 描画順。挿入順を 保つ dict なので クローンの 削除も O(1)
+        "sprite_order": {},
+        "logical": {"xmin": -240, "xmax": 240, "ymin": -180, "ymax": 180},
+        "fps": 30,
+        "screen": None,
+        "clock": None,
+        "window_size": (960, 720),
+        # 読み込んだ 画像 (パスごと)。合計バイト数が image_cache_bytes を 超えたら 古い 順に 捨てる
+        "images_cache": collections.OrderedDict(),
+        "images_bytes": 0,
+        "image_cache_bytes": 128 * 1024 * 1024,
+        "image_stats": {"hits": 0, "misses": 0, "evictions": 0},
+        # 裏で 読み込み中の 画像と、その 画像を 待っている Sprite
+        "preload_pool": None,
+        "preload_jobs": {},
+        "preload_waiting": {},
+        # 画像を 展開済みの RGBAで 保存しておく ディレクトリ (Noneなら 使わない)
+        "disk_cache_dir": None,
+        "foreign_depth": 0,
+        "running": True,
+
+        # クローンごとの (テンプレート, クローン名)。行は 取り出す ときに 組み立てる
+        "pending_to_clambon": collections.deque(),
+        "pending_lines": 0,
+        "drain_line": 0,
+        "max_drain_per_frame": 64,
+        # 1フレームの うち 取り出した 行の 実行に 使ってよい 割合 (Noneなら 行数で 区切る)
+        "drain_budget": None,
+        "drain_cost": None,
+        "drain_mark": None,
+        "drain_stats": {"lines": 0, "backlog": 0, "seconds": 0.0, "limit": 0},
+
+        # compile_programで 分類した プログラムの 行 (_plansと 違って 捨てない)
+        "program_plans": {},
+
+        "clone_scripts": {},
+        "clone_templates": {},
+        "clone_counter": {},
+        "clone_capture": None,
+
+        "ppu": 2,
+
+        "globals": {},
+
+        "clones": {},
+        "touch_grids": {},
+        "collision": "rect",
+
+        # (元画像, 角度) ごとの 回転済み 画像。Sprite / クローン 全体で 共有する
+        "rotations": collections.OrderedDict(),
+        "rotations_bytes": 0,
+        "rotation_cache_bytes": 64 * 1024 * 1024,
+
+        "dirty_rects": False,
+        # 1より 小さいと 縮小した 画面に 描いてから 拡大して 表示する ("logical"なら 論理座標 1 = 1ピクセル)
+        "render_scale": 1.0,
+        "framebuffer": None,
+        "drawn": None,
+
+        "headless": False,
+        "fixed_step": False,
+        "max_frames": None,
+        "frame": 0,
+
+        "batch": None,
+
+        # tickごとに 1回 取り込む キーの 状態 (押している / このフレームで 押した / 離した)
+        "keys": {"held": frozenset(), "hit": frozenset(), "released": frozenset()},
+        # 前の tickの pygame.key.get_pressed()。変わった ときだけ 押している キーを 数え直す
+        "key_snapshot": None,
+        # キー入力の 記録先 / 再生元の ファイル (on_importで 開く)
+        "record_input": None,
+        "replay_input": None,
+        "input_log": None,
+        "input_replay": None,
+
+        # 終了時に 結果 (フレーム数・Spriteの 状態など) を JSONで 書き出す ファイル
+        "report_path": None,
+        "report_written": False,
+        # atexitに 登録した 書き出し関数 (Worldを 閉じる ときに 外す)
+        "report_atexit": None,
+
+        # 計測 (profile_startで 有効)。Noneの 間は どこも 計らない
+        "profile": None,
+        "profile_dump": None,
+        "profile_every": 300,
+
+        # pygame全体の 終了は 既定の Worldだけが 行う
+        "owns_pygame": True,
+    }
+
+_state = _new_state()
+_default_state = _state
+
+# 実行中の World の 状態を _state に 差し替えて 呼ぶ。
+# 差し替えは ロックの 中だけなので、別スレッドの Worldと 混ざらない
+_world_lock = threading.RLock()
+_world_owner = None
+
+def _run_in(state, fn, args=(), kw=None):
+    global _state, _world_owner
+    with _world_lock:
+        prev, prev_owner = _state, _world_owner
+        _state, _world_owner = state, threading.get_ident()
+        try:
+            return fn(*args, **(kw or {}))
+        finally:
+            _state, _world_owner = prev, prev_owner
+
+def _api_state():
+    # World の 中から 呼ばれた ときは その World、それ以外は 既定の World
+    if _world_owner == threading.get_ident():
+        return _state
+    return _default_state
+
+def _world_api(fn):
+    @functools.wraps(fn)
+    def api(*args, **kw):
+        if _world_owner == threading.get_ident():
+            return fn(*args, **kw)
+        return _run_in(_default_state, fn, args, kw)
+    return api
+
+_CONFIG_KEYS = ("ppu", "max_drain_per_frame", "drain_budget", "rotation_cache_bytes", "dirty_rects",
+                "headless", "fixed_step", "max_frames", "image_cache_bytes", "disk_cache_dir",
+                "record_input", "replay_input", "report_path",
+                "profile_dump", "profile_every", "render_scale")
+
+def _env_flag(v):
+    return v.strip().lower() not in ("", "0", "false", "no", "off")
+
+# ホスト側の コードを 変えずに 設定できる 環境変数 (既定の Worldの on_importの たびに 読む)
+_ENV_OPTIONS = {
+    "CLAGE_HEADLESS": ("headless", _env_flag),
+    "CLAGE_FIXED_STEP": ("fixed_step", _env_flag),
+    "CLAGE_MAX_FRAMES": ("max_frames", int),
+    "CLAGE_CACHE_DIR": ("disk_cache_dir", str),
+    "CLAGE_RECORD_INPUT": ("record_input", str),
+    "CLAGE_REPLAY_INPUT": ("replay_input", str),
+    "CLAGE_REPORT": ("report_path", str),
+    "CLAGE_PROFILE": ("profile_dump", str),
+    "CLAGE_PROFILE_EVERY": ("profile_every", int),
+    "CLAGE_RENDER_SCALE": ("render_scale", lambda v: v if v.strip() == "logical" else float(v)),
 }
 
+_ENV_PRELOAD = "CLAGE_PRELOAD"
+
+# ディスクキャッシュの 形式 (変えたら 番号を 上げる)
+_DISK_IMAGE_MAGIC = b"CLGI0001"
+_DISK_ATLAS_MAGIC = b"CLGR0001"
+_DISK_IMAGE_HEAD = struct.Struct("<8sII")
+_DISK_ATLAS_HEAD = struct.Struct("<8sI")
+_DISK_ATLAS_ENTRY = struct.Struct("<HII")
+
+# キー入力ログ: 先頭に MAGIC、変化の あった フレームごとに (フレーム番号, 各集合の 個数) と キーコード
+_INPUT_MAGIC = b"CLGK0001"
+_INPUT_FRAME = struct.Struct("<IHHH")
+_PRELOAD_WORKERS = 4
+_RE_IMAGE_LITERAL = re.compile(r'"([^"\n]+\.(?:png|jpe?g|bmp|gif|tga|webp))"', re.IGNORECASE)
+
+_DIRTY_MAX_RECTS = 16
+
+_TOUCH_CELL = 64
+_TOUCH_GRID_MIN = 16
+_COLLISION_MODES = ("rect", "precise")
+_TOUCH_KEYS = frozenset(("x", "y", "direction", "image", "visible"))
+
 _RE_STAGE_OPEN = re.compile(r'^\s*Stage\s*\(\s*\)\s*\{\s*$')
 _RE_SPRITE_OPEN = re.compile(r'^\s*Sprite\s*\(\s*"([^"]+)"\s*\)\s*\{\s*$')
 _RE_START_OPEN = re.compile(r'^\s*start\s*\{\s*$')
@@ -39,6 +198,7 @@ _RE_FPS_SET = re.compile(r'^\s*fps\.set\s*\(\s*([^\)]+)\s*\)\s*$')
 _RE_WIDTH_SET = re.compile(r'^\s*width\.set\s*\(\s*([^,]+)\s*,\s*([^\)]+)\s*\)\s*$')
 _RE_HEIGHT_SET = re.compile(r'^\s*height\.set\s*\(\s*([^,]+)\s*,\s*([^\)]+)\s*\)\s*$')
 _RE_RUN = re.compile(r'^\s*run\s*\(\s*\)\s*$')
+_RE_COLLISION_SET = re.compile(r'^\s*collision\.set\s*\(\s*([^\)]+)\s*\)\s*$')
 
 _NAME = r'([A-Za-z_]\w*(?:#\d+)?)'
 
@@ -48,9 +208,16 @@ _RE_SHOW_CMD = re.compile(rf'^\s*{_NAME}\.show\s*\(\s*\)\s*$')
 _RE_HIDE_CMD = re.compile(rf'^\s*{_NAME}\.hide\s*\(\s*\)\s*$')
 
 _RE_TOUCHING_CALL = re.compile(rf'\b{_NAME}\s*\.\s*touching\s*\(\s*([^)]+?)\s*\)')
+_RE_PRESSED_CALL = re.compile(r'\b(pressed|just_pressed|just_released)\s*\(\s*([^)]+)\s*\)')
 
 _SPR_REF_RE = re.compile(rf'\b{_NAME}\s*\.\s*(x|y|direction)\b')
 
+# "Enemy#*" は Enemyの クローン 全部を まとめて 表す
+_GROUP = r'([A-Za-z_]\w*)#\*'
+_RE_GROUP_PROP_SET = re.compile(rf'^\s*{_GROUP}\s*\.\s*(x|y|direction)\s*=\s*(.+?)\s*$')
+_RE_GROUP_MOVE = re.compile(rf'^\s*{_GROUP}\.move\s*\(\s*([^\)]+)\s*\)\s*$')
+_GROUP_REF_RE = re.compile(rf'\b{_GROUP}\s*\.\s*(x|y|direction)\b')
+
 _RE_CLONE_OPEN = re.compile(r'^\s*clone\s*\{\s*$')
 _RE_CLONE_CMD = re.compile(r'^\s*clone\s*\(\s*([A-Za-z_]\w*)\s*\)\s*$')
 _RE_INTERNAL_CLONE_DELETE = re.compile(r'^\s*__clage_clone_delete__\s*\(\s*"([^"]+)"\s*\)\s*$')
@@ -61,10 +228,88 @@ _RE_VAR_DECL = re.compile(r'^\s*var\s+([A-Za-z_]\w*)\s*=\s*(.+?)\s*$')
 _RE_ASSIGN   = re.compile(r'^\s*([A-Za-z_]\w*)\s*=\s*(.+?)\s*$')
 
 _RE_ARRAY_ELEM = re.compile(r'\b([A-Za-z_]\w*)\s*\[\s*([^\]]+)\s*\]')
+# 10進数 以外の 数値 ("0x10", "1_000", "1j") や "#" は 以前の 文字チェックと 同じく 認めない
+_RE_EXPR_REJECT = re.compile(r'#|\b\d\w*[_xXbBoOjJ]')
+_RE_EXPR_SLOT = re.compile(r'__clage_(?:s(\d+)_(x|y|direction)|n(\d+))__')
+# 10進数の 数値 (先頭が 0の 整数 "007" などは Pythonと 同じく 認めないので そのまま 残す)
+_RE_EXPR_NUMBER = re.compile(r'(?<![\w.])(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?(?![\w.])')
 
 _RE_STOP_ALL   = re.compile(r'^\s*stop\.all\s*\(\s*\)\s*$')
 _RE_STOP_ALIAS = re.compile(r'^\s*stop\s*\(\s*\)\s*$')
 
+_RE_CLONE_IDENT = re.compile(r'\bclone\b')
+# cloneブロックの 行を 分類する ときに クローン名の 代わりに 入れる 名前
+_CLONE_SLOT = "__clage_clone__#0"
+_RE_LINE_HEAD = re.compile(r'\s*([A-Za-z_]\w*(?:#\d+|#\*)?)\s*(?:\.\s*([A-Za-z_]\w*))?')
+
+
+class _CloneLine(str):
+    # drain_pending_linesが 返す クローンの 行 (クローン名を 埋めた 文字列)。
+    # 分類済みの planも 持つので、そのまま 届けば process_lineは 解析し直さない
+    plan = None
+
+class Sprite:
+    # 1つの Spriteまたは クローン。クローンが 多くても 軽いように __slots__を 使う
+    __slots__ = ("name", "x", "y", "direction", "costume", "image", "visible", "is_clone",
+                 "_render_img", "_render_angle", "_render_src", "_render_mask", "_world")
+
+    def __init__(self, name):
+        self.name = name
+        self.x = 0.0
+        self.y = 0.0
+        self.direction = 90.0
+        self.costume = None
+        self.image = None
+        self.visible = True
+        self.is_clone = False
+        self._render_img = None
+        self._render_angle = None
+        self._render_src = None
+        self._render_mask = None
+        # 登録先の Worldの 状態 (当たり判定の グリッドを 更新する ときに 使う)
+        self._world = None
+
+    def copy(self, name):
+        sp = Sprite.__new__(Sprite)
+        sp.name = name
+        sp.x = self.x
+        sp.y = self.y
+        sp.direction = self.direction
+        sp.costume = self.costume
+        sp.image = self.image
+        sp.visible = self.visible
+        sp.is_clone = self.is_clone
+        sp._render_img = self._render_img
+        sp._render_angle = self._render_angle
+        sp._render_src = self._render_src
+        sp._render_mask = self._render_mask
+        sp._world = None
+        return sp
+
+    # 以前の dict形式の Sprite (sp["x"] など) と 同じ 書き方も 使えるように する
+    def __getitem__(self, key):
+        if key not in Sprite.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in Sprite.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+        # 位置や 見た目が 変わったら この Spriteが いる Worldの 当たり判定の グリッドも 更新する
+        if key in _TOUCH_KEYS and self._world is not None:
+            _run_in(self._world, _touch_mark, (self.name,))
+
+    def __contains__(self, key):
+        return key in Sprite.__slots__
+
+    def get(self, key, default=None):
+        if key not in Sprite.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return Sprite.__slots__
 
 def _in_stage():
     return "Stage" in _state["block_stack"]
@@ -94,6 +339,7 @@ def _to_string_literal(t):
         return s[1:-1]
     return None
 
+@functools.lru_cache(maxsize=1024)
 def _resolve_path(path):
     candidates = [path,
                   os.path.join(os.getcwd(), path),
@@ -103,85 +349,389 @@ def _resolve_path(path):
             return p
     return None
 
+def _cache_image(path, img):
+    if pygame.display.get_surface() is not None:
+        img = img.convert_alpha()
+    cache = _state["images_cache"]
+    old = cache.pop(path, None)
+    if old is not None:
+        _state["images_bytes"] -= old[1]
+    nbytes = img.get_pitch() * img.get_height()
+    cache[path] = (img, nbytes)
+    _state["images_bytes"] += nbytes
+    # 使用中の Spriteは 画像を 持ったままなので、捨てても 表示には 影響しない
+    while _state["images_bytes"] > _state["image_cache_bytes"] and len(cache) > 1:
+        _, (_, b) = cache.popitem(last=False)
+        _state["images_bytes"] -= b
+        _state["image_stats"]["evictions"] += 1
+    return img
+
+@functools.lru_cache(maxsize=1024)
+def _disk_key(rp, mtime_ns, size):
+    # 中身の ハッシュを キーに するので、ファイルを 移動・コピーしても キャッシュが 使える
+    h = hashlib.sha1()
+    with open(rp, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _disk_cache_path(rp, ext, d):
+    if not d:
+        return None
+    try:
+        st = os.stat(rp)
+        return os.path.join(d, _disk_key(rp, st.st_mtime_ns, st.st_size) + ext)
+    except OSError:
+        return None
+
+def _disk_map(cpath):
+    with open(cpath, "rb") as f:
+        # ACCESS_COPY: Surfaceに 描き込んでも ファイルは 変わらない
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+def _disk_write(cpath, chunks):
+    try:
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        tmp = f"{cpath}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            for c in chunks:
+                f.write(c)
+        os.replace(tmp, cpath)
+    except OSError:
+        pass
+
+def _decode_image(rp, cache_dir):
+    # 別スレッドからも 呼ばれるので _state は 見ない。ディスクキャッシュが あれば PNGなどの 展開を 省く
+    cpath = _disk_cache_path(rp, ".rgba", cache_dir)
+    if cpath is not None and os.path.exists(cpath):
+        try:
+            buf = _disk_map(cpath)
+            magic, w, h = _DISK_IMAGE_HEAD.unpack_from(buf)
+            if magic == _DISK_IMAGE_MAGIC and len(buf) == _DISK_IMAGE_HEAD.size + w * h * 4:
+                return pygame.image.frombuffer(buf[_DISK_IMAGE_HEAD.size:], (w, h), "RGBA")
+        except (OSError, ValueError, struct.error):
+            pass
+    img = pygame.image.load(rp)
+    if cpath is not None:
+        w, h = img.get_size()
+        _disk_write(cpath, (_DISK_IMAGE_HEAD.pack(_DISK_IMAGE_MAGIC, w, h),
+                            pygame.image.tobytes(img, "RGBA")))
+    return img
+
 def _load_image(path):
-    if path in _state["images_cache"]:
-        return _state["images_cache"][path]
+    ent = _state["images_cache"].get(path)
+    if ent is not None:
+        _state["images_cache"].move_to_end(path)
+        _state["image_stats"]["hits"] += 1
+        return ent[0]
+    _state["image_stats"]["misses"] += 1
+    job = _state["preload_jobs"].pop(path, None)
+    if job is not None:
+        # 読み込み中なら 終わるのを 待つ (順番に 読むより 遅く なることは ない)
+        try:
+            return _cache_image(path, job.result())
+        except Exception:
+            return None
     rp = _resolve_path(path)
     if rp is None:
         return None
     try:
-        img = pygame.image.load(rp).convert_alpha()
-        _state["images_cache"][path] = img
-        return img
+        return _cache_image(path, _decode_image(rp, _state["disk_cache_dir"]))
     except Exception:
         return None
 
-def _substitute_sprite_refs(expr: str) -> str:
-    def repl(m):
-        name, prop = m.group(1), m.group(2)
-        sp = _state["sprites"].get(name)
+def _preload_pool():
+    pool = _state["preload_pool"]
+    if pool is None:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=_PRELOAD_WORKERS,
+                                                     thread_name_prefix="clage-preload")
+        _state["preload_pool"] = pool
+    return pool
+
+@_world_api
+def preload_images(paths) -> int:
+    # 画像の 読み込みだけを 別スレッドで 行う (convert_alphaは tickの 中で メインスレッドが 行う)
+    n = 0
+    for path in paths:
+        if path in _state["images_cache"] or path in _state["preload_jobs"]:
+            continue
+        rp = _resolve_path(path)
+        if rp is None:
+            continue
+        _state["preload_jobs"][path] = _preload_pool().submit(_decode_image, rp, _state["disk_cache_dir"])
+        n += 1
+    return n
+
+def _read_program(path_or_text, what):
+    if "\n" not in path_or_text and os.path.isfile(path_or_text):
+        try:
+            with open(path_or_text, encoding="utf-8") as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            print(f'{what}エラー: "{path_or_text}"を 読み込めません')
+            return None
+    return path_or_text
+
+@_world_api
+def preload_program(path_or_text: str) -> int:
+    text = _read_program(path_or_text, "preload")
+    if text is None:
+        return 0
+    paths = list(dict.fromkeys(_RE_IMAGE_LITERAL.findall(text)))
+    return preload_images(paths)
+
+def _poll_preload():
+    jobs = _state["preload_jobs"]
+    if not jobs:
+        return
+    for path in [p for p, job in jobs.items() if job.done()]:
+        job = jobs.pop(path)
+        try:
+            img = _cache_image(path, job.result())
+        except Exception:
+            img = None
+        for spr in [n for n, p in _state["preload_waiting"].items() if p == path]:
+            del _state["preload_waiting"][spr]
+            sp = _state["sprites"].get(spr)
+            if sp is None or sp.costume != path:
+                continue
+            if img is None:
+                print(f'costumeエラー: "{path}"を 読み込めません')
+            _set_sprite_image(spr, sp, img)
+
+def _set_sprite_image(spr, sp, img):
+    sp.image = img
+    sp._render_img = None
+    sp._render_src = None
+    _touch_mark(spr)
+
+@_world_api
+def image_cache_stats():
+    st = dict(_state["image_stats"])
+    st["entries"] = len(_state["images_cache"])
+    st["bytes"] = _state["images_bytes"]
+    st["pending"] = len(_state["preload_jobs"])
+    return st
+
+_EXPR_ERR_CHARS = "数式に 関係ない 文字が 含まれています"
+_EXPR_ERR_EVAL = "数式の 評価に 失敗しました"
+
+_EXPR_BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+def _expr_sprite_ref(i, prop):
+    def get(st, b):
+        sp = st["sprites"].get(b[i])
         if not sp:
-            return "0"
+            return 0
         try:
-            return str(float(sp[prop]))
+            return float(getattr(sp, prop))
         except Exception:
-            return "0"
-    return _SPR_REF_RE.sub(repl, expr)
-
-def _substitute_global_vars(expr: str) -> str:
-    if not _state["globals"]:
-        return expr
-    for k in sorted(_state["globals"].keys(), key=len, reverse=True):
-        v = _state["globals"][k]
+            return 0
+    return get
+
+def _expr_global_ref(name):
+    def get(st, b):
+        v = st["globals"].get(name)
         if isinstance(v, (int, float)):
-            expr = re.sub(rf'\b{k}\b', str(float(v)), expr)
-    return expr
+            return float(v)
+        raise ValueError(_EXPR_ERR_CHARS)
+    return get
 
-def _eval_number_expr_no_arrays(expr: str):
-    expr2 = _substitute_sprite_refs(expr)
-    expr2 = _substitute_global_vars(expr2)
-    lit = _to_number_literal(expr2)
-    if lit is not None:
-        return float(lit)
-    if not re.fullmatch(r'[0-9eE\.\+\-\*\/%\(\)\s]+', expr2):
-        raise ValueError("数式に 関係ない 文字が 含まれています")
-    val = eval(expr2, {"__builtins__": {}}, {})
-    if isinstance(val, (int, float)):
-        return float(val)
-    raise ValueError("数式の 評価に 失敗しました")
-
-def _substitute_array_elems(expr: str) -> str:
-    def repl(m):
-        name = m.group(1)
-        idx_expr = m.group(2)
-        arr = _state["globals"].get(name)
+def _expr_array_ref(name, idx_fn):
+    def get(st, b):
+        arr = st["globals"].get(name)
         if not isinstance(arr, (list, tuple)):
-            return m.group(0)
+            raise ValueError(_EXPR_ERR_CHARS)
         try:
-            idx = int(_eval_number_expr_no_arrays(idx_expr))
+            idx = int(idx_fn(st, b))
         except Exception:
-            return m.group(0)
+            raise ValueError(_EXPR_ERR_CHARS)
         if not (0 <= idx < len(arr)):
-            return "0"
+            return 0
         val = arr[idx]
         if isinstance(val, (int, float)):
-            return str(float(val))
-        return "0"
-    return _RE_ARRAY_ELEM.sub(repl, expr)
-
-def _eval_number_expr(expr: str):
-    expr2 = _substitute_sprite_refs(expr)
-    expr2 = _substitute_global_vars(expr2)
-    expr2 = _substitute_array_elems(expr2)
-    lit = _to_number_literal(expr2)
+            return float(val)
+        return 0
+    return get
+
+def _expr_build(node, refs):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        v = node.value
+        return lambda st, b: v
+    if isinstance(node, ast.BinOp) and type(node.op) in _EXPR_BINOPS:
+        op = _EXPR_BINOPS[type(node.op)]
+        lhs = _expr_build(node.left, refs)
+        rhs = _expr_build(node.right, refs)
+        return lambda st, b: op(lhs(st, b), rhs(st, b))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operand = _expr_build(node.operand, refs)
+        return lambda st, b: -operand(st, b)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+        operand = _expr_build(node.operand, refs)
+        return lambda st, b: +operand(st, b)
+    if isinstance(node, ast.Name):
+        if node.id in refs:
+            return refs[node.id]
+        m = _RE_EXPR_SLOT.fullmatch(node.id)
+        if m and m.group(3) is not None:
+            i = int(m.group(3))
+            return lambda st, b: b[i]
+        if m:
+            return _expr_sprite_ref(int(m.group(1)), m.group(2))
+        return _expr_global_ref(node.id)
+    raise ValueError(_EXPR_ERR_CHARS)
+
+def _expr_parse(text, refs):
+    if _RE_EXPR_REJECT.search(text):
+        raise ValueError(_EXPR_ERR_CHARS)
+    return _expr_build(ast.parse(text.strip(), mode="eval").body, refs)
+
+def _expr_fail(exc):
+    cls, args = type(exc), exc.args
+    def fail(*_):
+        raise cls(*args)
+    return fail
+
+def _expr_parse_or_fail(text, refs):
+    try:
+        return _expr_parse(text, refs)
+    except Exception as e:
+        return _expr_fail(e)
+
+def _expr_literal(text, lit):
+    # "inf" や "nan" は 同名の グローバル変数が あれば そちらが 優先
+    if not text.isidentifier():
+        return lambda st: lit
+    def get(st):
+        v = st["globals"].get(text)
+        if isinstance(v, (int, float)):
+            return float(v)
+        return lit
+    return get
+
+def _expr_placeholder(refs, fn):
+    key = f"__clage_ref{len(refs)}__"
+    refs[key] = fn
+    return key
+
+def _expr_shape(text):
+    # Sprite名と 数値を 抜き出して "Enemy#3.x + 1" → "__clage_s0_x__ + __clage_n1__", ("Enemy#3", 1) に する
+    bound = []
+    def sprite(m):
+        bound.append(m.group(1))
+        return f"__clage_s{len(bound) - 1}_{m.group(2)}__"
+    def number(m):
+        t = m.group(0)
+        bound.append(int(t) if t.isdigit() else float(t))
+        return f"__clage_n{len(bound) - 1}__"
+    text = _SPR_REF_RE.sub(sprite, text)
+    return _RE_EXPR_NUMBER.sub(number, text), tuple(bound)
+
+def _expr_compile_shape(shape, refs):
+    shape = _RE_ARRAY_ELEM.sub(
+        lambda m: _expr_placeholder(refs, _expr_array_ref(m.group(1), _expr_parse_or_fail(m.group(2), refs))),
+        shape)
+    return _expr_parse(shape, refs)
+
+@functools.lru_cache(maxsize=1024)
+def _compile_shape(shape: str):
+    # クローンごとに Sprite名だけが 違う 式は 同じ 形として 1回だけ 解析する
+    try:
+        fn = _expr_compile_shape(shape, {})
+    except Exception as e:
+        return _expr_fail(ValueError(_EXPR_ERR_CHARS) if isinstance(e, SyntaxError) else e)
+
+    def evaluate(st, b):
+        val = fn(st, b)
+        if isinstance(val, (int, float)):
+            return float(val)
+        raise ValueError(_EXPR_ERR_EVAL)
+    return evaluate
+
+@functools.lru_cache(maxsize=4096)
+def _compile_number_expr(expr: str):
+    # 式の 文字列ごとに 1回だけ 解析して、評価時に Spriteや 変数を 直接 読む 関数を 作る
+    text = expr.strip()
+    lit = _to_number_literal(text)
     if lit is not None:
-        return float(lit)
-    if not re.fullmatch(r'[0-9eE\.\+\-\*\/%\(\)\s]+', expr2):
-        raise ValueError("数式に 関係ない 文字が 含まれています")
-    val = eval(expr2, {"__builtins__": {}}, {})
-    if isinstance(val, (int, float)):
-        return float(val)
-    raise ValueError("数式の 評価に 失敗しました")
+        return _expr_literal(text, float(lit))
+    shape, names = _expr_shape(text)
+    fn = _compile_shape(shape)
+    return lambda st: fn(st, names)
+
+def _eval_number_expr(expr):
+    # クローンの テンプレートで 解析済みの 式は (評価関数, 名前, 文字列) の 組で 渡される
+    if type(expr) is tuple:
+        return expr[0](_state, expr[1])
+    return _compile_number_expr(expr)(_state)
+
+@functools.lru_cache(maxsize=1024)
+def _compile_group_expr(expr: str, base: str):
+    # "Enemy#*.x" は クローンごとの 値 (numpyが あれば 配列) として 読む
+    refs = {}
+    props = []
+    def group_ref(m):
+        if m.group(1) != base:
+            raise ValueError(_EXPR_ERR_CHARS)
+        prop = m.group(2)
+        if prop not in props:
+            props.append(prop)
+        return _expr_placeholder(refs, lambda st, b: st["batch"][prop])
+    try:
+        text = _GROUP_REF_RE.sub(group_ref, expr.strip())
+        shape, names = _expr_shape(text)
+        fn = _expr_compile_shape(shape, refs)
+    except Exception as e:
+        return _expr_fail(ValueError(_EXPR_ERR_CHARS) if isinstance(e, SyntaxError) else e), ()
+    return (lambda st: fn(st, names)), tuple(props)
+
+# numpyは 読み込みに 時間が かかるので "#*" の 命令を 初めて 使う ときに 読み込む
+np = None
+_np_loaded = False
+
+def _numpy():
+    global np, _np_loaded
+    if not _np_loaded:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+        _np_loaded = True
+    return np
+
+def _group_column(members, prop):
+    return np.fromiter((getattr(sp, prop) for sp in members), float, len(members))
+
+def _eval_group_expr(expr: str, base: str, members):
+    fn, props = _compile_group_expr(expr, base)
+    _numpy()
+    try:
+        if np is not None:
+            _state["batch"] = {p: _group_column(members, p) for p in props}
+            with np.errstate(divide="raise", invalid="raise", over="raise"):
+                val = np.asarray(fn(_state), dtype=float)
+            if val.ndim == 0:
+                val = np.full(len(members), float(val))
+            return val
+        vals = []
+        for sp in members:
+            _state["batch"] = {p: getattr(sp, p) for p in props}
+            val = fn(_state)
+            if not isinstance(val, (int, float)):
+                raise ValueError(_EXPR_ERR_EVAL)
+            vals.append(float(val))
+        return vals
+    finally:
+        _state["batch"] = None
 
 def _logical_to_screen(x, y):
     xmin, xmax = _state["logical"]["xmin"], _state["logical"]["xmax"]
@@ -204,47 +754,246 @@ def _apply_window_from_logical():
 
     size_changed = tuple(new_size) != tuple(_state["window_size"])
     _state["window_size"] = new_size
+    _state["touch_grids"].clear()
 
     if size_changed and _state.get("screen") is not None:
-        _state["screen"] = pygame.display.set_mode(new_size)
-        pygame.display.set_caption("clage")
+        _state["screen"] = _open_screen(new_size)
+        _state["drawn"] = None
+
+def _open_screen(size):
+    if _state["headless"]:
+        disp = pygame.display.get_surface()
+        if not _state["owns_pygame"] or (disp is not None and disp is not _state["screen"]):
+            # 画面は ほかの Worldが 使っているので 自分用の Surfaceに 描く
+            return pygame.Surface(size)
+        try:
+            return pygame.display.set_mode(size)
+        except pygame.error:
+            return pygame.Surface(size)
+    screen = pygame.display.set_mode(size)
+    pygame.display.set_caption("clage")
+    return screen
+
+def _present(rects=None):
+    if _state["headless"]:
+        return
+    if rects is None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(rects)
+
+def _rotation_entry(base, angle, scale=1.0):
+    cache = _state["rotations"]
+    key = (base, angle % 360, scale)
+    ent = cache.get(key)
+    prof = _state["profile"]
+    if ent is not None:
+        cache.move_to_end(key)
+        if prof is not None:
+            prof["caches"]["rotations"][0] += 1
+        return ent
+    if prof is not None:
+        prof["caches"]["rotations"][1] += 1
+    return _rotation_store(base, key[1], pygame.transform.rotozoom(base, -(key[1] - 90.0), scale), scale)
+
+def _rotation_store(base, angle, rotated, scale=1.0):
+    cache = _state["rotations"]
+    key = (base, angle, scale)
+    old = cache.pop(key, None)
+    if old is not None:
+        _state["rotations_bytes"] -= old[2]
+    nbytes = rotated.get_pitch() * rotated.get_height()
+    ent = [rotated, None, nbytes]
+    cache[key] = ent
+    _state["rotations_bytes"] += nbytes
+    while _state["rotations_bytes"] > _state["rotation_cache_bytes"] and len(cache) > 1:
+        _, old = cache.popitem(last=False)
+        _state["rotations_bytes"] -= old[2]
+    return ent
 
 def _ensure_render_image(sp):
-    base = sp.get("image")
+    base = sp.image
     if base is None:
-        sp["_render_img"] = None
-        sp["_render_angle"] = None
-        sp["_render_src"] = None
+        sp._render_img = None
+        sp._render_angle = None
+        sp._render_src = None
         return None
 
-    angle = float(sp.get("direction", 90.0))
-    snapped = int(round(angle))
+    snapped = int(round(float(sp.direction)))
+
+    if (sp._render_img is None or
+        sp._render_angle != snapped or
+        sp._render_src is not base):
+        sp._render_img = _rotation_entry(base, snapped)[0]
+        sp._render_angle = snapped
+        sp._render_src = base
+        sp._render_mask = None
+        if _state["profile"] is not None:
+            _state["profile"]["caches"]["render"][1] += 1
+    elif _state["profile"] is not None:
+        _state["profile"]["caches"]["render"][0] += 1
 
-    if (sp.get("_render_img") is None or
-        sp.get("_render_angle") != snapped or
-        sp.get("_render_src") is not base):
-        rotated = pygame.transform.rotozoom(base, -(snapped - 90.0), 1.0)
-        sp["_render_img"] = rotated
-        sp["_render_angle"] = snapped
-        sp["_render_src"] = base
+    return sp._render_img
+
+def _sprite_mask(sp, rect):
+    img = _ensure_render_image(sp)
+    if img is None:
+        return pygame.Mask(rect.size, fill=True)
+    if sp._render_mask is None:
+        ent = _rotation_entry(sp.image, sp._render_angle)
+        if ent[1] is None:
+            ent[1] = pygame.mask.from_surface(ent[0])
+        sp._render_mask = ent[1]
+    return sp._render_mask
+
+@_world_api
+def prewarm_rotations(path: str) -> bool:
+    img = _load_image(path)
+    if img is None:
+        return False
+    cpath = _disk_cache_path(_resolve_path(path), ".rot", _state["disk_cache_dir"])
+    if cpath is not None and _load_rotation_atlas(img, cpath):
+        return True
+    for angle in range(360):
+        _rotation_entry(img, angle)
+    if cpath is not None:
+        _save_rotation_atlas(img, cpath)
+    return True
+
+def _save_rotation_atlas(img, cpath):
+    # 360度 分の 回転済み 画像を 1つの ファイルに まとめる
+    rots = [_rotation_entry(img, angle)[0] for angle in range(360)]
+    table = [_DISK_ATLAS_ENTRY.pack(a, *r.get_size()) for a, r in enumerate(rots)]
+    _disk_write(cpath, [_DISK_ATLAS_HEAD.pack(_DISK_ATLAS_MAGIC, len(rots))] + table
+                + [pygame.image.tobytes(r, "RGBA") for r in rots])
+
+def _load_rotation_atlas(img, cpath):
+    if not os.path.exists(cpath):
+        return False
+    try:
+        buf = _disk_map(cpath)
+        magic, n = _DISK_ATLAS_HEAD.unpack_from(buf)
+        if magic != _DISK_ATLAS_MAGIC:
+            return False
+        pos = _DISK_ATLAS_HEAD.size
+        table = []
+        for _ in range(n):
+            table.append(_DISK_ATLAS_ENTRY.unpack_from(buf, pos))
+            pos += _DISK_ATLAS_ENTRY.size
+        if len(buf) != pos + sum(w * h * 4 for _, w, h in table):
+            return False
+        for angle, w, h in table:
+            size = w * h * 4
+            _rotation_store(img, angle, pygame.image.frombuffer(buf[pos:pos + size], (w, h), "RGBA"))
+            pos += size
+    except (OSError, ValueError, struct.error):
+        return False
+    return True
 
-    return sp["_render_img"]
+def _masks_overlap(sp1, r1, sp2, r2):
+    m1 = _sprite_mask(sp1, r1)
+    m2 = _sprite_mask(sp2, r2)
+    return m1.overlap(m2, (r2.x - r1.x, r2.y - r1.y)) is not None
 
 def _sprite_rect(name: str):
     sp = _state["sprites"].get(name)
     if not sp:
         return None
-    sx, sy = _logical_to_screen(sp["x"], sp["y"])
+    sx, sy = _logical_to_screen(sp.x, sp.y)
     img = _ensure_render_image(sp)
     if img is None:
         return pygame.Rect(sx - 25, sy - 25, 50, 50)
     return img.get_rect(center=(sx, sy))
 
-def _is_touching(self_name: str, target: str) -> bool:
+def _clone_bases(name: str):
+    # "Enemy#3" は "Enemy" の クローンとして 数える ("#" より 前の 部分 すべて)
+    i = name.find("#")
+    while i != -1:
+        yield name[:i]
+        i = name.find("#", i + 1)
+
+def _register_sprite(name: str, sp):
+    sp._world = _state
+    _state["sprites"][name] = sp
+    _state["sprite_order"][name] = None
+    for base in _clone_bases(name):
+        _state["clones"].setdefault(base, {})[name] = sp
+    _touch_mark(name)
+
+def _unregister_sprite(name: str):
+    if _state["sprites"].pop(name, None) is None:
+        return
+    _state["sprite_order"].pop(name, None)
+    _state["preload_waiting"].pop(name, None)
+    for base in _clone_bases(name):
+        group = _state["clones"].get(base)
+        if group is not None:
+            group.pop(name, None)
+    _touch_mark(name)
+
+def _touch_mark(name: str):
+    # 当たり判定用の グリッドは 次に 問い合わせが 来た ときに まとめて 更新する
+    grids = _state["touch_grids"]
+    if not grids:
+        return
+    g = grids.get(name)
+    if g is not None:
+        g["dirty"].add(name)
+    for base in _clone_bases(name):
+        g = grids.get(base)
+        if g is not None:
+            g["dirty"].add(name)
+
+def _grid_cells(r):
+    c = _TOUCH_CELL
+    for cx in range(r.left // c, (r.right - 1) // c + 1):
+        for cy in range(r.top // c, (r.bottom - 1) // c + 1):
+            yield (cx, cy)
+
+def _grid_remove(g, name):
+    rect = g["rects"].pop(name, None)
+    if rect is None:
+        return
+    for key in _grid_cells(rect):
+        bucket = g["cells"].get(key)
+        if bucket is not None:
+            bucket.pop(name, None)
+            if not bucket:
+                del g["cells"][key]
+
+def _grid_insert(g, name):
+    sp = _state["sprites"].get(name)
+    if not sp or not sp.visible:
+        return
+    rect = _sprite_rect(name)
+    if rect is None:
+        return
+    g["rects"][name] = rect
+    for key in _grid_cells(rect):
+        g["cells"].setdefault(key, {})[name] = None
+
+def _touch_grid(target: str):
+    g = _state["touch_grids"].get(target)
+    if g is None:
+        g = {"cells": {}, "rects": {}, "dirty": set()}
+        _state["touch_grids"][target] = g
+        if target in _state["sprites"]:
+            _grid_insert(g, target)
+        for nm in _state["clones"].get(target, ()):
+            _grid_insert(g, nm)
+        return g
+    if g["dirty"]:
+        for nm in g["dirty"]:
+            _grid_remove(g, nm)
+            _grid_insert(g, nm)
+        g["dirty"].clear()
+    return g
+
+def _is_touching(self_name: str, target: str, precise=None) -> bool:
     if not _state.get("screen") or not _state.get("running", True):
         return False
     sp_self = _state["sprites"].get(self_name)
-    if not sp_self or not sp_self.get("visible", True):
+    if not sp_self or not sp_self.visible:
         return False
     r1 = _sprite_rect(self_name)
     if r1 is None:
@@ -254,25 +1003,40 @@ def _is_touching(self_name: str, target: str) -> bool:
         W, H = _state["window_size"]
         return (r1.left <= 0 or r1.right >= W or r1.top <= 0 or r1.bottom >= H)
 
+    if precise is None:
+        precise = _state["collision"] == "precise"
+
     tgt_name = str(target)
-    candidates = []
-    if tgt_name in _state["sprites"]:
-        candidates.append(tgt_name)
-    prefix = tgt_name + "#"
-    for nm in _state["sprites"].keys():
-        if nm.startswith(prefix):
-            candidates.append(nm)
-
-    if not candidates:
+    group = _state["clones"].get(tgt_name, {})
+
+    if len(group) < _TOUCH_GRID_MIN:
+        candidates = [tgt_name] if tgt_name in _state["sprites"] else []
+        candidates.extend(group)
+        for nm in candidates:
+            sp_t = _state["sprites"].get(nm)
+            if not sp_t or not sp_t.visible:
+                continue
+            r2 = _sprite_rect(nm)
+            if r2 and r1.colliderect(r2):
+                if not precise or _masks_overlap(sp_self, r1, sp_t, r2):
+                    return True
         return False
 
-    for nm in candidates:
-        sp_t = _state["sprites"].get(nm)
-        if not sp_t or not sp_t.get("visible", True):
+    g = _touch_grid(tgt_name)
+    cells, rects = g["cells"], g["rects"]
+    seen = set()
+    for key in _grid_cells(r1):
+        bucket = cells.get(key)
+        if not bucket:
             continue
-        r2 = _sprite_rect(nm)
-        if r2 and r1.colliderect(r2):
-            return True
+        for nm in bucket:
+            if nm in seen:
+                continue
+            seen.add(nm)
+            r2 = rects[nm]
+            if r1.colliderect(r2):
+                if not precise or _masks_overlap(sp_self, r1, _state["sprites"][nm], r2):
+                    return True
     return False
 
 _KEYMAP = {
@@ -286,12 +1050,124 @@ _KEYMAP = {
     "a": pygame.K_a, "s": pygame.K_s, "d": pygame.K_d, "w": pygame.K_w,
 }
 
-def _key_pressed(keyname: str) -> bool:
+_KEY_STATES = {"pressed": "held", "just_pressed": "hit", "just_released": "released"}
+
+@functools.lru_cache(maxsize=512)
+def _key_code(keyname: str):
+    # "right arrow" などの 別名の ほかは pygameの キー名 ("right", "q", "f1", "left ctrl" ...)
+    name = keyname.lower().strip()
+    code = _KEYMAP.get(name)
+    if code is not None:
+        return code
+    try:
+        return pygame.key.key_code(name)
+    except ValueError:
+        return None
+
+def _key_pressed(keyname: str, state: str = "held") -> bool:
     if not _state.get("running", True):
         return False
-    keys = pygame.key.get_pressed()
-    code = _KEYMAP.get(str(keyname).lower().strip())
-    return bool(code and keys[code])
+    code = _key_code(str(keyname))
+    return code is not None and code in _state["keys"][state]
+
+# get_pressed()の 位置 (スキャンコード) → キーコード
+_SCANCODE_KEYS = {}
+
+def _scancode_keys(snapshot):
+    if not _SCANCODE_KEYS:
+        # 位置の 番号を 並べた ものを 同じ 型で 作り、キーコードで 引くと スキャンコードが 分かる
+        index = type(snapshot)(range(len(snapshot)))
+        for name in dir(pygame):
+            if not name.startswith("K_"):
+                continue
+            code = getattr(pygame, name)
+            try:
+                sc = index[code]
+            except (IndexError, TypeError, ValueError):
+                continue
+            if sc:
+                _SCANCODE_KEYS.setdefault(sc, code)
+    return _SCANCODE_KEYS
+
+def _poll_keys(prev_held):
+    # キーの 状態は イベントでは なく get_pressed()で 1フレームに 1回 読む
+    # (ホストが 先に イベントを 取っても、起動前から 押していても、キーリピートでも ずれない)
+    snapshot = pygame.key.get_pressed()
+    if snapshot == _state["key_snapshot"]:
+        return prev_held
+    _state["key_snapshot"] = snapshot
+    keys = _scancode_keys(snapshot)
+    return frozenset(keys[i] for i, down in enumerate(snapshot) if down and i in keys)
+
+def _set_keys(held, hit, released):
+    _state["keys"] = {"held": frozenset(held), "hit": frozenset(hit), "released": frozenset(released)}
+
+def _input_open():
+    _input_close()
+    path = _state["replay_input"]
+    if path:
+        _state["input_replay"] = _read_input_log(path)
+    path = _state["record_input"]
+    if path:
+        try:
+            f = open(path, "wb")
+            f.write(_INPUT_MAGIC)
+            _state["input_log"] = f
+        except OSError:
+            print(f'recordエラー: "{path}"に 書き込めません')
+
+def _input_close():
+    f = _state["input_log"]
+    _state["input_log"] = None
+    _state["input_replay"] = None
+    if f is not None:
+        try:
+            f.close()
+        except OSError:
+            pass
+
+def _read_input_log(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        print(f'replayエラー: "{path}"を 読み込めません')
+        return None
+    if not data.startswith(_INPUT_MAGIC):
+        print(f'replayエラー: "{path}"は キー入力の 記録では ありません')
+        return None
+    frames = {}
+    pos = len(_INPUT_MAGIC)
+    try:
+        while pos < len(data):
+            frame, nh, nd, nr = _INPUT_FRAME.unpack_from(data, pos)
+            pos += _INPUT_FRAME.size
+            codes = struct.unpack_from(f"<{nh + nd + nr}I", data, pos)
+            pos += 4 * len(codes)
+            frames[frame] = (codes[:nh], codes[nh:nh + nd], codes[nh + nd:])
+    except struct.error:
+        # 途中で 終わっている 記録は 読めた ところまで 使う
+        pass
+    return frames
+
+def _record_keys(prev_held):
+    f = _state["input_log"]
+    k = _state["keys"]
+    if f is None or not (k["hit"] or k["released"] or k["held"] != prev_held):
+        return
+    held, hit, released = sorted(k["held"]), sorted(k["hit"]), sorted(k["released"])
+    codes = held + hit + released
+    try:
+        f.write(_INPUT_FRAME.pack(_state["frame"], len(held), len(hit), len(released)))
+        f.write(struct.pack(f"<{len(codes)}I", *codes))
+    except OSError:
+        _input_close()
+
+def _replay_keys():
+    rec = _state["input_replay"].get(_state["frame"])
+    if rec is None:
+        return _state["keys"]["held"], (), ()
+    return rec
 
 def _sanitize_token(s: str) -> str:
     s = s.strip()
@@ -299,28 +1175,143 @@ def _sanitize_token(s: str) -> str:
         s = s[1:-1]
     return s
 
+def _visible_sprites():
+    for name in _state["sprite_order"]:
+        sp = _state["sprites"].get(name)
+        if not sp or not sp.visible:
+            continue
+        sx, sy = _logical_to_screen(sp.x, sp.y)
+        img = _ensure_render_image(sp)
+        if img is None:
+            yield name, pygame.Rect(sx - 25, sy - 25, 50, 50), None
+        else:
+            yield name, img.get_rect(center=(sx, sy)), img
+
+def _blit_sprite(screen, rect, img):
+    if img is None:
+        pygame.draw.rect(screen, (180, 180, 180), rect)
+    else:
+        screen.blit(img, rect.topleft)
+
+def _render_scale():
+    s = _state["render_scale"]
+    if s == "logical":
+        s = 1.0 / max(int(_state.get("ppu", 2)), 1)
+    try:
+        s = float(s)
+    except (TypeError, ValueError):
+        return 1.0
+    return min(max(s, 0.05), 1.0)
+
 def _draw_frame():
     if _state["screen"] is None:
         return
+    scale = _render_scale()
+    if scale != 1.0:
+        _draw_frame_scaled(scale)
+        return
+    if _state["dirty_rects"]:
+        _draw_frame_dirty()
+        return
     _state["screen"].fill((255, 255, 255))
+    for name, rect, img in _visible_sprites():
+        _blit_sprite(_state["screen"], rect, img)
+    _present()
+
+def _draw_frame_scaled(scale):
+    # 小さい 画面に 縮小した 画像で 描き、最後に 1回だけ 拡大して 表示する。
+    # 当たり判定は これまで どおり 実際の 画面の 大きさで 行う
+    screen = _state["screen"]
+    W, H = screen.get_size()
+    size = (max(int(W * scale), 1), max(int(H * scale), 1))
+    fb = _state["framebuffer"]
+    if fb is None or fb.get_size() != size:
+        fb = pygame.Surface(size, 0, screen)
+        _state["framebuffer"] = fb
+    fb.fill((255, 255, 255))
+    box = max(int(50 * scale), 1)
     for name in _state["sprite_order"]:
         sp = _state["sprites"].get(name)
-        if not sp or not sp.get("visible", True):
+        if not sp or not sp.visible:
             continue
-        sx, sy = _logical_to_screen(sp["x"], sp["y"])
-        img = _ensure_render_image(sp)
-        if img is None:
-            pygame.draw.rect(_state["screen"], (180, 180, 180),
-                             pygame.Rect(sx - 25, sy - 25, 50, 50))
+        sx, sy = _logical_to_screen(sp.x, sp.y)
+        center = (int(sx * scale), int(sy * scale))
+        if sp.image is None:
+            rect = pygame.Rect(0, 0, box, box)
+            rect.center = center
+            pygame.draw.rect(fb, (180, 180, 180), rect)
         else:
-            rect = img.get_rect(center=(sx, sy))
-            _state["screen"].blit(img, rect.topleft)
-    pygame.display.flip()
+            img = _rotation_entry(sp.image, int(round(float(sp.direction))), scale)[0]
+            fb.blit(img, img.get_rect(center=center))
+    pygame.transform.scale(fb, (W, H), screen)
+    _state["drawn"] = None
+    _present()
+
+def _draw_frame_dirty():
+    # 前の フレームから 位置や 画像が 変わった Spriteの 周りだけ 描き直す
+    screen = _state["screen"]
+    prev = _state["drawn"]
+    cur = {}
+    items = []
+    for name, rect, img in _visible_sprites():
+        cur[name] = (rect, img)
+        items.append((rect, img))
+    _state["drawn"] = cur
+
+    dirty = None
+    if prev is not None:
+        dirty = []
+        for name, (rect, img) in cur.items():
+            old = prev.get(name)
+            if old is None:
+                dirty.append(rect)
+            elif old[1] is not img or old[0] != rect:
+                dirty.append(old[0])
+                dirty.append(rect)
+        for name, (rect, img) in prev.items():
+            if name not in cur:
+                dirty.append(rect)
+        if not dirty:
+            return
+        if len(dirty) > _DIRTY_MAX_RECTS:
+            dirty = [dirty[0].unionall(dirty[1:])]
+        W, H = _state["window_size"]
+        if sum(r.w * r.h for r in dirty) * 2 > W * H:
+            dirty = None
+
+    if dirty is None:
+        screen.fill((255, 255, 255))
+        for rect, img in items:
+            _blit_sprite(screen, rect, img)
+        _present()
+        return
+
+    for area in dirty:
+        screen.set_clip(area)
+        screen.fill((255, 255, 255), area)
+        for rect, img in items:
+            if rect.colliderect(area):
+                _blit_sprite(screen, rect, img)
+    screen.set_clip(None)
+    _present(dirty)
+
+@_world_api
+def configure(**options):
+    for k, v in options.items():
+        if k not in _CONFIG_KEYS:
+            raise TypeError(f"configure: 不明な オプション {k}")
+        _state[k] = v
 
 def _stop_all():
     if not _state.get("running", True):
         return
     _state["running"] = False
+    _input_close()
+    _write_report()
+    if not _state["owns_pygame"]:
+        # ほかの Worldが pygameを 使っているので 画面だけ 手放す
+        _state["screen"] = None
+        return
     try:
         if _state.get("screen") is not None:
             pygame.display.quit()
@@ -331,9 +1322,92 @@ def _stop_all():
     except Exception:
         pass
 
+def _close_world():
+    _stop_all()
+    for job in _state["preload_jobs"].values():
+        job.cancel()
+    _state["preload_jobs"].clear()
+    _state["preload_waiting"].clear()
+    pool = _state["preload_pool"]
+    if pool is not None:
+        _state["preload_pool"] = None
+        pool.shutdown(wait=False)
+    fn = _state["report_atexit"]
+    if fn is not None:
+        _state["report_atexit"] = None
+        atexit.unregister(fn)
+
+def _report():
+    return {
+        "frames": _state["frame"],
+        "running": bool(_state["running"]),
+        "sprites": sprite_states(),
+        "globals": dict(_state["globals"]),
+        "drain": dict(_state["drain_stats"]),
+        "images": image_cache_stats(),
+    }
+
+def _write_report():
+    path = _state["report_path"]
+    if not path or _state["report_written"]:
+        return
+    _state["report_written"] = True
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(_report(), f, ensure_ascii=False, default=str)
+    except OSError:
+        print(f'reportエラー: "{path}"に 書き込めません')
+
+def _write_report_at_exit(state):
+    # max_framesに 届く 前に ホストが 終わった ときも 結果を 残す
+    if state["report_path"] and not state["report_written"]:
+        _run_in(state, _write_report)
+
+def _apply_env_options():
+    for env, (key, conv) in _ENV_OPTIONS.items():
+        v = os.environ.get(env)
+        if v is None:
+            continue
+        try:
+            _state[key] = conv(v)
+        except ValueError:
+            print(f"{env}: 値が 正しく ありません")
+
+# headlessに する 前の SDL_VIDEODRIVER。headlessを やめた ときに 元に 戻す
+_saved_video_driver = {"saved": False, "value": None}
+
+def _apply_video_driver(headless):
+    if headless:
+        # 画面の ない 環境でも 画像の 読み込みと 当たり判定が 使えるように dummyドライバを 使う
+        if pygame.display.get_init() and pygame.display.get_driver() != "dummy":
+            pygame.display.quit()
+        if not _saved_video_driver["saved"]:
+            _saved_video_driver["saved"] = True
+            _saved_video_driver["value"] = os.environ.get("SDL_VIDEODRIVER")
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        return
+    if not _saved_video_driver["saved"]:
+        return
+    prev = _saved_video_driver["value"]
+    _saved_video_driver["saved"] = False
+    _saved_video_driver["value"] = None
+    if prev is None:
+        os.environ.pop("SDL_VIDEODRIVER", None)
+    else:
+        os.environ["SDL_VIDEODRIVER"] = prev
+    if prev != "dummy" and pygame.display.get_init() and pygame.display.get_driver() == "dummy":
+        pygame.display.quit()
+
+@_world_api
 def on_import():
+    # 環境変数は プロセス 全体で 共通なので 既定の Worldだけが 読む
+    if _state is _default_state:
+        _apply_env_options()
+    if _state["owns_pygame"]:
+        _apply_video_driver(_state["headless"])
     pygame.init()
     _state["clock"] = pygame.time.Clock()
+    _state["frame"] = 0
 
     _state["stage_defined"] = False
     _state["block_stack"].clear()
@@ -341,57 +1415,287 @@ def on_import():
     _state["sprite_order"].clear()
     _state["logical"].update({"xmin": -240, "xmax": 240, "ymin": -180, "ymax": 180})
     _state["fps"] = 30
+    _state["collision"] = "rect"
     _state["images_cache"].clear()
+    _state["images_bytes"] = 0
+    _state["image_stats"] = {"hits": 0, "misses": 0, "evictions": 0}
+    _state["preload_jobs"].clear()
+    _state["preload_waiting"].clear()
+    _resolve_path.cache_clear()
+    _key_code.cache_clear()
+    _set_keys((), (), ())
+    _state["key_snapshot"] = None
+    _input_open()
+    _state["report_written"] = False
+    if _state["profile_dump"] or _state["profile"] is not None:
+        _state["profile"] = _new_profile()
+    if _state["report_path"] and _state["report_atexit"] is None:
+        _state["report_atexit"] = functools.partial(_write_report_at_exit, _state)
+        atexit.register(_state["report_atexit"])
+    _state["rotations"].clear()
+    _state["rotations_bytes"] = 0
+    _state["drawn"] = None
+    _state["framebuffer"] = None
     _state["foreign_depth"] = 0
     _state["running"] = True
 
     _state["pending_to_clambon"].clear()
-    _state["drain_cursor"] = 0
+    _state["pending_lines"] = 0
+    _state["drain_line"] = 0
+    _state["drain_cost"] = None
+    _state["drain_mark"] = None
+    _state["drain_stats"] = {"lines": 0, "backlog": 0, "seconds": 0.0, "limit": 0}
 
     _state["clone_scripts"].clear()
+    _state["clone_templates"].clear()
     _state["clone_counter"].clear()
     _state["clone_capture"] = None
 
     _state["globals"].clear()  # グローバル変数の初期化
+    _state["clones"].clear()
+    _state["touch_grids"].clear()
 
     _apply_window_from_logical()
-    _state["screen"] = pygame.display.set_mode(_state["window_size"])
-    pygame.display.set_caption("clage")
+    _state["screen"] = _open_screen(_state["window_size"])
+
+    program = os.environ.get(_ENV_PRELOAD) if _state is _default_state else None
+    if program:
+        compile_program(program)
+        preload_program(program)
 
 def tick():
+    _tick_in(_api_state())
+
+def _tick_in(state):
+    # fpsに 合わせて 待つ 間は ロックを 放して ほかの Worldを 止めない
+    if _run_in(state, _tick) and not state["fixed_step"] and state.get("clock"):
+        if state["profile"] is None:
+            state["clock"].tick(max(state.get("fps", 30), 1))
+        else:
+            t = time.perf_counter()
+            state["clock"].tick(max(state.get("fps", 30), 1))
+            state["profile"]["tick"]["sleep"] += time.perf_counter() - t
+    if state["profile"] is not None:
+        _run_in(state, _profile_frame_end)
+
+def _tick():
+    _drain_measure()
+    _poll_preload()
     if _state.get("screen") is None or not _state.get("running", True):
+        return False
+    prev_held = held = _state["keys"]["held"]
+    if not _state["headless"]:
+        focus_lost = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                _state["running"] = False
+                try:
+                    if _state["owns_pygame"]:
+                        pygame.quit()
+                finally:
+                    return False
+            if event.type == pygame.WINDOWFOCUSLOST:
+                focus_lost = True
+        held = _poll_keys(prev_held)
+        if focus_lost:
+            # 画面の 外で 離された キーは 分からないので 全部 離した ことに する
+            held = frozenset()
+            _state["key_snapshot"] = None
+    if _state["input_replay"] is not None:
+        # 再生中は 実際の キー入力の 代わりに 記録を 使う
+        held, hit, released = _replay_keys()
+    else:
+        hit, released = held - prev_held, prev_held - held
+    _set_keys(held, hit, released)
+    _record_keys(prev_held)
+    if _state["profile"] is None:
+        _draw_frame()
+    else:
+        t = time.perf_counter()
+        _draw_frame()
+        _state["profile"]["tick"]["draw"] += time.perf_counter() - t
+    _state["frame"] += 1
+    if _state["max_frames"] is not None and _state["frame"] >= _state["max_frames"]:
+        _stop_all()
+    return _state["running"]
+
+@_world_api
+def run_frames(n: int, on_frame=None) -> int:
+    # 待ち時間なしで nフレーム 進める。on_frame(frame)は 各フレームの 描画前に 呼ばれる
+    done = 0
+    while done < n and _state.get("running", True) and _state.get("screen") is not None:
+        if on_frame is not None:
+            on_frame(_state["frame"])
+        _tick()
+        if _state["profile"] is not None:
+            _profile_frame_end()
+        done += 1
+    return done
+
+def _drain_limit():
+    n = max(int(_state.get("max_drain_per_frame", 64)), 1)
+    budget = _state.get("drain_budget")
+    cost = _state.get("drain_cost")
+    if budget is None or not cost:
+        return n
+    frame_s = 1.0 / max(_state.get("fps", 30), 1)
+    return max(int(frame_s * budget / cost), 1)
+
+def _drain_measure():
+    # 前回 取り出した 行が 次の tickまでに かかった 時間から 1行あたりの コストを 見積もる
+    mark = _state["drain_mark"]
+    if mark is None:
         return
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            _state["running"] = False
-            try:
-                pygame.quit()
-            finally:
-                return
-    _draw_frame()
-    if _state.get("clock"):
-        _state["clock"].tick(max(_state.get("fps", 30), 1))
-
+    _state["drain_mark"] = None
+    t0, lines = mark
+    elapsed = time.perf_counter() - t0
+    _state["drain_stats"]["seconds"] = elapsed
+    if _state["profile"] is not None:
+        _state["profile"]["tick"]["drain"] += elapsed
+    if lines:
+        sample = elapsed / lines
+        cost = _state["drain_cost"]
+        _state["drain_cost"] = sample if cost is None else cost * 0.8 + sample * 0.2
+
+@_world_api
 def drain_pending_lines():
-    buf = _state.get("pending_to_clambon", [])
-    cur = _state.get("drain_cursor", 0)
-    n = _state.get("max_drain_per_frame", 64)
-    if not buf:
-        _state["drain_cursor"] = 0
-        return []
-    chunk = buf[cur:cur+n]
-    cur += len(chunk)
-    if cur >= len(buf):
-        _state["pending_to_clambon"] = []
-        _state["drain_cursor"] = 0
-    else:
-        _state["drain_cursor"] = cur
+    buf = _state["pending_to_clambon"]
+    pos = _state["drain_line"]
+    n = _drain_limit()
+    chunk = []
+    while buf and len(chunk) < n:
+        templ, cname = buf[0]
+        take = templ[pos:pos + n - len(chunk)]
+        chunk.extend([_bind_clone_line(e, cname) for e in take])
+        pos += len(take)
+        if pos >= len(templ):
+            buf.popleft()
+            pos = 0
+    _state["drain_line"] = pos
+    _state["pending_lines"] -= len(chunk)
+    _state["drain_stats"] = {"lines": len(chunk), "backlog": _state["pending_lines"],
+                             "seconds": 0.0, "limit": n}
+    _state["drain_mark"] = (time.perf_counter(), len(chunk)) if chunk else None
     return chunk
 
-def _assign_global(name: str, rhs: str):
-    rhs_s = rhs.strip()
+@_world_api
+def drain_stats():
+    return dict(_state["drain_stats"])
+
+def _new_profile():
+    return {
+        "handlers": {},
+        "frames": 0,
+        "slow_frames": 0,
+        "tick": {"frame": 0.0, "drain": 0.0, "draw": 0.0, "sleep": 0.0},
+        # [ヒット, ミス]
+        "caches": {"render": [0, 0], "rotations": [0, 0]},
+        "images": dict(_state["image_stats"]),
+        "mark": None,
+    }
+
+def _profiled(fn, *args, name=None):
+    t = time.perf_counter()
     try:
-        num = _eval_number_expr(rhs_s)
+        return fn(*args)
+    finally:
+        dt = time.perf_counter() - t
+        if name is None:
+            name = fn.__name__[5:] if fn.__name__.startswith("_cmd_") else fn.__name__
+        ent = _state["profile"]["handlers"].get(name)
+        if ent is None:
+            ent = _state["profile"]["handlers"][name] = [0, 0.0]
+        ent[0] += 1
+        ent[1] += dt
+
+def _profile_frame_end():
+    prof = _state["profile"]
+    now = time.perf_counter()
+    if prof["mark"] is not None:
+        dt = now - prof["mark"]
+        prof["frames"] += 1
+        prof["tick"]["frame"] += dt
+        # 目標の fpsに 間に 合わなかった フレーム
+        if dt > 1.0 / max(_state.get("fps", 30), 1):
+            prof["slow_frames"] += 1
+    else:
+        # 最初の フレームは 始まりが 分からないので 数えない
+        prof["tick"] = dict.fromkeys(prof["tick"], 0.0)
+    prof["mark"] = now
+    every = max(int(_state["profile_every"] or 0), 1)
+    if _state["profile_dump"] and prof["frames"] and prof["frames"] % every == 0:
+        _profile_dump(_state["profile_dump"])
+
+def _hit_rate(hits, misses):
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else None}
+
+@_world_api
+def profile_start():
+    _state["profile"] = _new_profile()
+
+@_world_api
+def profile_stop():
+    stats = profile_stats()
+    _state["profile"] = None
+    return stats
+
+@_world_api
+def profile_stats():
+    prof = _state["profile"]
+    if prof is None:
+        return None
+    n = max(prof["frames"], 1)
+    tick = dict(prof["tick"])
+    # フレームの うち 計った 部分 以外 (ホストでの 実行や process_lineなど)
+    tick["other"] = max(tick["frame"] - tick["drain"] - tick["draw"] - tick["sleep"], 0.0)
+    img0, img = prof["images"], _state["image_stats"]
+    return {
+        "frames": prof["frames"],
+        "slow_frames": prof["slow_frames"],
+        "fps_target": _state["fps"],
+        "tick_ms": {k: v / n * 1000 for k, v in tick.items()},
+        "tick_seconds": tick,
+        "handlers": {name: {"calls": c, "seconds": t, "us_per_call": t / c * 1e6}
+                     for name, (c, t) in sorted(prof["handlers"].items(), key=lambda kv: -kv[1][1])},
+        "caches": {
+            "images": _hit_rate(img["hits"] - img0["hits"], img["misses"] - img0["misses"]),
+            "render": _hit_rate(*prof["caches"]["render"]),
+            "rotations": _hit_rate(*prof["caches"]["rotations"]),
+        },
+    }
+
+def _profile_dump(path):
+    stats = profile_stats()
+    try:
+        if path.lower().endswith(".csv"):
+            # 1回の 書き出しごとに 行を 追記する。時間は seconds、キャッシュの 割合は hit_rateの 列だけに 書く
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            with open(path, "a", newline="", encoding="utf-8") as f:
+                w = csv.writer(f)
+                if new:
+                    w.writerow(["frame", "kind", "name", "calls", "seconds", "hits", "misses", "hit_rate"])
+                fr = _state["frame"]
+                for k, v in stats["tick_seconds"].items():
+                    w.writerow([fr, "tick", k, stats["frames"], f"{v:.6f}", "", "", ""])
+                for k, v in stats["handlers"].items():
+                    w.writerow([fr, "handler", k, v["calls"], f"{v['seconds']:.6f}", "", "", ""])
+                for k, v in stats["caches"].items():
+                    rate = "" if v["hit_rate"] is None else f"{v['hit_rate']:.6f}"
+                    w.writerow([fr, "cache", k, v["hits"] + v["misses"], "", v["hits"], v["misses"], rate])
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(stats, f, ensure_ascii=False, indent=2)
+    except OSError:
+        print(f'profileエラー: "{path}"に 書き込めません')
+
+def _assign_global(name: str, rhs):
+    if type(rhs) is tuple:
+        expr, rhs_s = rhs, rhs[2]
+    else:
+        expr = rhs_s = rhs.strip()
+    try:
+        num = _eval_number_expr(expr)
         _state["globals"][name] = num
         return
     except Exception:
@@ -403,290 +1707,460 @@ def _assign_global(name: str, rhs: str):
     except Exception:
         _state["globals"][name] = rhs_s
 
-def process_line(line: str) -> str:
-    stripped = line.strip()
+def _touching_eval_sub(m):
+    self_name = m.group(1)
+    args = m.group(2).split(",")
+    target_tok = _sanitize_token(args[0])
+    precise = None
+    if len(args) == 2:
+        mode = _sanitize_token(args[1]).lower()
+        if mode in _COLLISION_MODES:
+            precise = mode == "precise"
+        else:
+            target_tok = _sanitize_token(m.group(2))
+    elif len(args) > 2:
+        target_tok = _sanitize_token(m.group(2))
+    return "true" if _is_touching(self_name, target_tok, precise) else "false"
 
-    if stripped == "" or stripped.startswith("//") or stripped.startswith("import "):
-        return line
+def _pressed_eval_sub(m):
+    return "true" if _key_pressed(_sanitize_token(m.group(2)), _KEY_STATES[m.group(1)]) else "false"
 
-    if _state["clone_capture"] is not None:
-        cap = _state["clone_capture"]
-        if stripped == "}":
-            cap["depth"] -= 1
-            if cap["depth"] == 0:
-                _state["clone_scripts"][cap["owner"]] = cap["lines"]
-                _state["clone_capture"] = None
-            else:
-                cap["lines"].append(line)
-            return ""
-        opens = line.count("{")
-        closes = line.count("}")
-        cap["lines"].append(line)
-        cap["depth"] += (opens - closes)
-        if cap["depth"] == 0:
-            _state["clone_scripts"][cap["owner"]] = cap["lines"]
-            _state["clone_capture"] = None
+def _cmd_stage_open(line):
+    if _state["stage_defined"]:
+        print('Stageエラー: Stage()は 1つだけ 宣言できます')
         return ""
+    _state["stage_defined"] = True
+    _state["block_stack"].append("Stage")
+    return "if ((true)) {"
 
-    def _touching_eval_sub(m):
-        self_name = m.group(1)
-        target_tok = _sanitize_token(m.group(2))
-        return "true" if _is_touching(self_name, target_tok) else "false"
-    line = _RE_TOUCHING_CALL.sub(_touching_eval_sub, line)
-
-    _RE_PRESSED_CALL = re.compile(r'\bpressed\s*\(\s*([^)]+)\s*\)')
-    def _pressed_eval_sub(m):
-        return "true" if _key_pressed(_sanitize_token(m.group(1))) else "false"
-    line = _RE_PRESSED_CALL.sub(_pressed_eval_sub, line)
-
-    m = _RE_STAGE_OPEN.match(line)
-    if m:
-        if _state["stage_defined"]:
-            print('Stageエラー: Stage()は 1つだけ 宣言できます')
-        else:
-            _state["stage_defined"] = True
-            _state["block_stack"].append("Stage")
-            return "if ((true)) {"
+def _cmd_sprite_open(line, name):
+    if name in _state["sprites"]:
+        print(f'Sprite名エラー: "{name}"は もう 使用されています')
         return ""
+    _register_sprite(name, Sprite(name))
+    _state["block_stack"].append(f"Sprite:{name}")
+    return "if ((true)) {"
 
-    m = _RE_SPRITE_OPEN.match(line)
-    if m:
-        name = m.group(1)
-        if name in _state["sprites"]:
-            print(f'Sprite名エラー: "{name}"は もう 使用されています')
-            return ""
-        _state["sprites"][name] = {"x": 0.0, "y": 0.0, "direction": 90.0,
-                                   "costume": None, "image": None, "visible": True,
-                                   "_render_img": None, "_render_angle": None, "_render_src": None}
-        _state["sprite_order"].append(name)
-        _state["block_stack"].append(f"Sprite:{name}")
-        return "if ((true)) {"
-
-    m = _RE_START_OPEN.match(line)
-    if m:
-        if not _state["block_stack"]:
-            print("startエラー: Stageか Spriteの 中だけで 使えます")
-            return ""
-        _state["block_stack"].append("Start")
-        return "if ((true)) {"
-
-    m = _RE_CLONE_OPEN.match(line)
-    if m:
-        if not _in_sprite():
-            print("cloneエラー: cloneブロックは Spriteの 中だけで 使えます")
-            return ""
-        sp_blocks = [b for b in _state["block_stack"] if b.startswith("Sprite:")]
-        if not sp_blocks:
-            print("cloneエラー: ブロックがありません）")
-            return ""
-        spname = sp_blocks[-1].split(":", 1)[1]
-        _state["clone_capture"] = {"owner": spname, "depth": 1, "lines": []}
+def _cmd_start_open(line):
+    if not _state["block_stack"]:
+        print("startエラー: Stageか Spriteの 中だけで 使えます")
         return ""
+    _state["block_stack"].append("Start")
+    return "if ((true)) {"
 
-    opens = line.count("{")
-    closes = line.count("}")
-    if opens or closes:
-        _state["foreign_depth"] += opens
-        for _ in range(closes):
-            if _state["foreign_depth"] > 0:
-                _state["foreign_depth"] -= 1
-            elif _state["block_stack"]:
-                _state["block_stack"].pop()
-        return line
-
-    m = _RE_FPS_SET.match(line)
-    if m:
-        if not _in_stage():
-            print("fpsは Stageの 中だけで 使えます")
-            return ""
-        v = _to_int_literal(m.group(1))
-        if v is None:
-            print("fps: 整数を 指定してください")
-            return ""
-        _state["fps"] = max(int(v), 1)
+def _cmd_clone_open(line):
+    if not _in_sprite():
+        print("cloneエラー: cloneブロックは Spriteの 中だけで 使えます")
         return ""
-
-    m = _RE_WIDTH_SET.match(line)
-    if m:
-        if not _in_stage():
-            print("widthは Stageの 中だけで 使えます")
-            return ""
-        a = _to_int_literal(m.group(1)); b = _to_int_literal(m.group(2))
-        if a is None or b is None or not (a < b):
-            print("width: min<maxの 整数を 使ってください")
-            return ""
-        _state["logical"]["xmin"] = int(a)
-        _state["logical"]["xmax"] = int(b)
-        _apply_window_from_logical()
+    sp_blocks = [b for b in _state["block_stack"] if b.startswith("Sprite:")]
+    if not sp_blocks:
+        print("cloneエラー: ブロックがありません）")
         return ""
+    spname = sp_blocks[-1].split(":", 1)[1]
+    _state["clone_capture"] = {"owner": spname, "depth": 1, "lines": []}
+    return ""
 
-    m = _RE_HEIGHT_SET.match(line)
-    if m:
-        if not _in_stage():
-            print("heightは Stageの 中だけで 使えます")
-            return ""
-        a = _to_int_literal(m.group(1)); b = _to_int_literal(m.group(2))
-        if a is None or b is None or not (a < b):
-            print("height: min<maxの 整数を 使ってください")
-            return ""
-        _state["logical"]["ymin"] = int(a)
-        _state["logical"]["ymax"] = int(b)
-        _apply_window_from_logical()
+def _cmd_fps_set(line, value):
+    if not _in_stage():
+        print("fpsは Stageの 中だけで 使えます")
         return ""
+    v = _to_int_literal(value)
+    if v is None:
+        print("fps: 整数を 指定してください")
+        return ""
+    _state["fps"] = max(int(v), 1)
+    return ""
 
-    m = _RE_RUN.match(line)
-    if m:
+def _cmd_width_set(line, lo, hi):
+    if not _in_stage():
+        print("widthは Stageの 中だけで 使えます")
+        return ""
+    a = _to_int_literal(lo); b = _to_int_literal(hi)
+    if a is None or b is None or not (a < b):
+        print("width: min<maxの 整数を 使ってください")
         return ""
+    _state["logical"]["xmin"] = int(a)
+    _state["logical"]["xmax"] = int(b)
+    _apply_window_from_logical()
+    return ""
 
-    m = _RE_STOP_ALL.match(line)
-    if m:
-        _stop_all()
+def _cmd_height_set(line, lo, hi):
+    if not _in_stage():
+        print("heightは Stageの 中だけで 使えます")
         return ""
+    a = _to_int_literal(lo); b = _to_int_literal(hi)
+    if a is None or b is None or not (a < b):
+        print("height: min<maxの 整数を 使ってください")
+        return ""
+    _state["logical"]["ymin"] = int(a)
+    _state["logical"]["ymax"] = int(b)
+    _apply_window_from_logical()
+    return ""
 
-    m = _RE_STOP_ALIAS.match(line)
-    if m:
-        _stop_all()
+def _cmd_collision_set(line, value):
+    if not _in_stage():
+        print("collisionは Stageの 中だけで 使えます")
+        return ""
+    mode = _sanitize_token(value).lower()
+    if mode not in _COLLISION_MODES:
+        print("collision: rectか preciseを 指定してください")
         return ""
+    _state["collision"] = mode
+    return ""
 
-    m = _RE_PROP_SET.match(line)
-    if m:
-        spr, prop, rhs = m.group(1), m.group(2), m.group(3).strip()
-        if spr not in _state["sprites"]:
-            print(f'Sprite参照エラー: "{spr}"は 宣言されていません')
-            return ""
-        sp = _state["sprites"][spr]
-        if prop in ("x", "y", "direction"):
-            try:
-                sp[prop] = float(_eval_number_expr(rhs))
-            except Exception:
-                print(f"{spr}.{prop}: 数値式を 指定してください")
-            return ""
-        if prop == "costume":
-            s = _to_string_literal(rhs)
-            if s is None:
-                print(f'{spr}: "画像ファイル名"で 指定してください')
-                return ""
-            sp["costume"] = s
-            img = _load_image(s)
-            if img is None:
-                print(f'costumeエラー: "{s}"を 読み込めません')
-                sp["image"] = None
-            else:
-                sp["image"] = img
-                sp["_render_img"] = None
-                sp["_render_src"] = None
-            return ""
+def _cmd_run(line):
+    return ""
 
-    m = _RE_CLONE_CMD.match(line)
-    if m:
-        src = m.group(1)
-        if src not in _state["sprites"]:
-            print(f'クローンエラー: "{src}"は 宣言されていません')
-            return ""
-        num = _state["clone_counter"].get(src, 0) + 1
-        _state["clone_counter"][src] = num
-        cname = f"{src}#{num}"
-
-        base = _state["sprites"][src]
-        copied = dict(base)
-        copied["is_clone"] = True
-        copied["_render_img"] = None
-        copied["_render_angle"] = None
-        copied["_render_src"] = None
-
-        _state["sprites"][cname] = copied
-        _state["sprite_order"].append(cname)
-
-        templ = _state["clone_scripts"].get(src)
-        if templ:
-            pat_clone_ident = re.compile(r'\bclone\b')
-            _state["pending_to_clambon"].append(f'__clage_sprite_ctx_open__("{cname}")')
-            for ln in templ:
-                ln2 = ln
-                if "clone.delete()" in ln2:
-                    ln2 = ln2.replace("clone.delete()", f'__clage_clone_delete__("{cname}")')
-                ln2 = pat_clone_ident.sub(cname, ln2)
-                _state["pending_to_clambon"].append(ln2)
-            _state["pending_to_clambon"].append('__clage_sprite_ctx_close__()')
-        return ""
-
-    m = _RE_MOVE_CMD.match(line)
-    if m:
-        spr_name, val = m.group(1), m.group(2)
-        if spr_name not in _state["sprites"]:
-            print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
-            return ""
-        if not _in_sprite():
-            print(f"{spr_name}.moveは Spriteの ブロックの中 だけで 使えます")
-            return ""
+def _cmd_stop_all(line):
+    _stop_all()
+    return ""
+
+def _cmd_prop_set(line, spr, prop, rhs):
+    if spr not in _state["sprites"]:
+        print(f'Sprite参照エラー: "{spr}"は 宣言されていません')
+        return ""
+    sp = _state["sprites"][spr]
+    if prop in ("x", "y", "direction"):
         try:
-            dist = _eval_number_expr(val)
+            setattr(sp, prop, float(_eval_number_expr(rhs)))
+            _touch_mark(spr)
         except Exception:
-            print(f"{spr_name}.move: 数値を 指定してください")
-            return ""
-        sp = _state["sprites"][spr_name]
-        rad = math.radians(float(sp["direction"]))
-        sp["x"] += float(dist) * math.sin(rad)
-        sp["y"] += float(dist) * math.cos(rad)
+            print(f"{spr}.{prop}: 数値式を 指定してください")
         return ""
-
-    m = _RE_INTERNAL_CLONE_DELETE.match(line)
-    if m:
-        target = m.group(1)
-        _state["sprites"].pop(target, None)
-        try:
-            _state["sprite_order"].remove(target)
-        except ValueError:
-            pass
+    s = _to_string_literal(rhs.strip())
+    if s is None:
+        print(f'{spr}: "画像ファイル名"で 指定してください')
         return ""
+    sp.costume = s
+    _state["preload_waiting"].pop(spr, None)
+    job = _state["preload_jobs"].get(s)
+    if job is not None and not job.done():
+        # 読み込みが 終わるまでは 今の 画像の まま (tickで 差し替える)
+        _state["preload_waiting"][spr] = s
+        return ""
+    img = _load_image(s)
+    if img is None:
+        print(f'costumeエラー: "{s}"を 読み込めません')
+    _set_sprite_image(spr, sp, img)
+    return ""
+
+def _clone_arg(g, expr, text):
+    # (0, 値): クローン名を 含まない / (1, 書式): 名前を 埋める /
+    # (2, 評価関数, 名前, 名前の 位置, 書式): 解析済みの 数式 (textなら 元の 文字列も 一緒に 渡す)
+    if g is None or _CLONE_SLOT not in g:
+        return (0, g)
+    if expr:
+        shape, names = _expr_shape(g.strip())
+        slots = tuple(i for i, n in enumerate(names) if n == _CLONE_SLOT)
+        return (2, _compile_shape(shape), names, slots, g if text else None)
+    return (1, g)
+
+def _compile_clone_line(ln):
+    # 行を 仮の クローン名で 1回だけ 分類しておき、クローンごとには 名前を 入れるだけに する
+    f = ln.replace("{", "{{").replace("}", "}}")
+    f = f.replace("clone.delete()", '__clage_clone_delete__("{0}")')
+    f = _RE_CLONE_IDENT.sub("{0}", f)
+    plan = _classify(f.format(_CLONE_SLOT))
+    # clageの 命令だけの 行は 数式も 先に 解析しておく
+    hidden = plan[0] == _PLAN_CMD and not plan[1] and plan[5] is not _cmd_assign
+    text = f.format("") if "{0}" not in f else None
+    if plan[0] == _PLAN_BLOCK or plan[0] == _PLAN_CMD:
+        fn, groups = plan[5], plan[6]
+        exprs = _PLAN_EXPR_ARGS.get(fn, ()) if hidden or fn is _cmd_assign else ()
+        if fn is _cmd_prop_set and groups[1] == "costume":
+            exprs = ()
+        spec = tuple(_clone_arg(g, i in exprs, fn is _cmd_assign) for i, g in enumerate(groups))
+        if any(a[0] for a in spec):
+            return (text, f, plan[:6], spec)
+    return (text, f, plan, None)
+
+def _compile_clone_template(lines):
+    if not lines:
+        return None
+    return tuple(_compile_clone_line(ln) for ln in
+                 ['__clage_sprite_ctx_open__("clone")'] + list(lines) + ['__clage_sprite_ctx_close__()'])
+
+def _bind_clone_line(entry, cname):
+    text, fmt, plan, spec = entry
+    if spec is not None:
+        args = []
+        for a in spec:
+            if a[0] == 0:
+                args.append(a[1])
+            elif a[0] == 1:
+                args.append(a[1].replace(_CLONE_SLOT, cname))
+            else:
+                names = list(a[2])
+                for i in a[3]:
+                    names[i] = cname
+                args.append((a[1], tuple(names), a[4] and a[4].replace(_CLONE_SLOT, cname)))
+        plan += (tuple(args),)
+    line = _CloneLine(fmt.format(cname) if text is None else text)
+    line.plan = plan
+    return line
 
-    m = _RE_INTERNAL_SPRITE_CTX_OPEN.match(line)
-    if m:
-        nm = m.group(1)
-        if nm not in _state["sprites"]:
-            print(f'内部エラー: Sprite "{nm}"が ありません')
-            return ""
-        _state["block_stack"].append(f"Sprite:{nm}")
-        return "if ((true)) {"
-
-    m = _RE_INTERNAL_SPRITE_CTX_CLOSE.match(line)
-    if m:
-        for i in range(len(_state["block_stack"]) - 1, -1, -1):
-            if _state["block_stack"][i].startswith("Sprite:"):
-                _state["block_stack"].pop(i)
-                break
-        return "}"
-
-    m = _RE_SHOW_CMD.match(line)
-    if m:
-        spr_name = m.group(1)
-        sp = _state["sprites"].get(spr_name)
-        if not sp:
-            print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
-            return ""
-        sp["visible"] = True
+def _finish_clone_capture(cap):
+    _state["clone_scripts"][cap["owner"]] = cap["lines"]
+    _state["clone_templates"][cap["owner"]] = _compile_clone_template(cap["lines"])
+    _state["clone_capture"] = None
+
+def _cmd_clone(line, src):
+    if src not in _state["sprites"]:
+        print(f'クローンエラー: "{src}"は 宣言されていません')
+        return ""
+    num = _state["clone_counter"].get(src, 0) + 1
+    _state["clone_counter"][src] = num
+    cname = f"{src}#{num}"
+
+    copied = _state["sprites"][src].copy(cname)
+    copied.is_clone = True
+
+    _register_sprite(cname, copied)
+    waiting = _state["preload_waiting"].get(src)
+    if waiting is not None:
+        _state["preload_waiting"][cname] = waiting
+
+    templ = _state["clone_templates"].get(src)
+    if templ:
+        _state["pending_to_clambon"].append((templ, cname))
+        _state["pending_lines"] += len(templ)
+    return ""
+
+def _cmd_move(line, spr_name, val):
+    if spr_name not in _state["sprites"]:
+        print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
+        return ""
+    if not _in_sprite():
+        print(f"{spr_name}.moveは Spriteの ブロックの中 だけで 使えます")
+        return ""
+    try:
+        dist = _eval_number_expr(val)
+    except Exception:
+        print(f"{spr_name}.move: 数値を 指定してください")
+        return ""
+    sp = _state["sprites"][spr_name]
+    rad = math.radians(float(sp.direction))
+    sp.x += float(dist) * math.sin(rad)
+    sp.y += float(dist) * math.cos(rad)
+    _touch_mark(spr_name)
+    return ""
+
+def _group_members(base):
+    return list(_state["clones"].get(base, {}).values())
+
+def _cmd_group_prop_set(line, base, prop, rhs):
+    if base not in _state["sprites"]:
+        print(f'Sprite参照エラー: "{base}"は 宣言されていません')
+        return ""
+    members = _group_members(base)
+    if not members:
         return ""
+    try:
+        vals = _eval_group_expr(rhs, base, members)
+    except Exception:
+        print(f"{base}#*.{prop}: 数値式を 指定してください")
+        return ""
+    if np is not None:
+        vals = vals.tolist()
+    for sp, v in zip(members, vals):
+        setattr(sp, prop, v)
+        _touch_mark(sp.name)
+    return ""
+
+def _cmd_group_move(line, base, val):
+    if base not in _state["sprites"]:
+        print(f'Sprite参照エラー: "{base}"は 宣言されていません')
+        return ""
+    if not _in_sprite():
+        print(f"{base}#*.moveは Spriteの ブロックの中 だけで 使えます")
+        return ""
+    members = _group_members(base)
+    if not members:
+        return ""
+    try:
+        dist = _eval_group_expr(val, base, members)
+    except Exception:
+        print(f"{base}#*.move: 数値を 指定してください")
+        return ""
+    if np is not None:
+        rad = np.radians(_group_column(members, "direction"))
+        xs = (_group_column(members, "x") + dist * np.sin(rad)).tolist()
+        ys = (_group_column(members, "y") + dist * np.cos(rad)).tolist()
+        for sp, x, y in zip(members, xs, ys):
+            sp.x = x
+            sp.y = y
+            _touch_mark(sp.name)
+        return ""
+    for sp, d in zip(members, dist):
+        rad = math.radians(float(sp.direction))
+        sp.x += d * math.sin(rad)
+        sp.y += d * math.cos(rad)
+        _touch_mark(sp.name)
+    return ""
+
+def _cmd_clone_delete(line, target):
+    _unregister_sprite(target)
+    return ""
+
+def _cmd_sprite_ctx_open(line, nm):
+    if nm not in _state["sprites"]:
+        print(f'内部エラー: Sprite "{nm}"が ありません')
+        return ""
+    _state["block_stack"].append(f"Sprite:{nm}")
+    return "if ((true)) {"
+
+def _cmd_sprite_ctx_close(line):
+    for i in range(len(_state["block_stack"]) - 1, -1, -1):
+        if _state["block_stack"][i].startswith("Sprite:"):
+            _state["block_stack"].pop(i)
+            break
+    return "}"
+
+def _cmd_show(line, spr_name):
+    sp = _state["sprites"].get(spr_name)
+    if not sp:
+        print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
+        return ""
+    sp.visible = True
+    _touch_mark(spr_name)
+    return ""
 
-    m = _RE_HIDE_CMD.match(line)
-    if m:
-        spr_name = m.group(1)
-        sp = _state["sprites"].get(spr_name)
-        if not sp:
-            print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
-            return ""
-        sp["visible"] = False
+def _cmd_hide(line, spr_name):
+    sp = _state["sprites"].get(spr_name)
+    if not sp:
+        print(f'Sprite参照エラー: "{spr_name}"は 宣言されていません')
         return ""
+    sp.visible = False
+    _touch_mark(spr_name)
+    return ""
 
-    m = _RE_VAR_DECL.match(line)
-    if m:
-        name, rhs = m.group(1), m.group(2)
-        _assign_global(name, rhs)
-        return line
+def _cmd_assign(line, name, rhs):
+    _assign_global(name, rhs)
+    return line
 
-    m = _RE_ASSIGN.match(line)
-    if m:
-        name, rhs = m.group(1), m.group(2)
-        _assign_global(name, rhs)
+# 行頭の 名前 (と ".メンバー") で 候補を 1つに 絞ってから 正規表現を 1回だけ 試す
+_BLOCK_OPENS = {
+    "Stage": (_RE_STAGE_OPEN, _cmd_stage_open),
+    "Sprite": (_RE_SPRITE_OPEN, _cmd_sprite_open),
+    "start": (_RE_START_OPEN, _cmd_start_open),
+    "clone": (_RE_CLONE_OPEN, _cmd_clone_open),
+}
+
+_HEAD_CMDS = {
+    "run": (_RE_RUN, _cmd_run),
+    "stop": (_RE_STOP_ALIAS, _cmd_stop_all),
+    "clone": (_RE_CLONE_CMD, _cmd_clone),
+    "var": (_RE_VAR_DECL, _cmd_assign),
+    "__clage_clone_delete__": (_RE_INTERNAL_CLONE_DELETE, _cmd_clone_delete),
+    "__clage_sprite_ctx_open__": (_RE_INTERNAL_SPRITE_CTX_OPEN, _cmd_sprite_ctx_open),
+    "__clage_sprite_ctx_close__": (_RE_INTERNAL_SPRITE_CTX_CLOSE, _cmd_sprite_ctx_close),
+}
+
+_STAGE_CMDS = {
+    ("fps", "set"): (_RE_FPS_SET, _cmd_fps_set),
+    ("width", "set"): (_RE_WIDTH_SET, _cmd_width_set),
+    ("height", "set"): (_RE_HEIGHT_SET, _cmd_height_set),
+    ("collision", "set"): (_RE_COLLISION_SET, _cmd_collision_set),
+    ("stop", "all"): (_RE_STOP_ALL, _cmd_stop_all),
+}
+
+_MEMBER_CMDS = {
+    "x": (_RE_PROP_SET, _cmd_prop_set),
+    "y": (_RE_PROP_SET, _cmd_prop_set),
+    "direction": (_RE_PROP_SET, _cmd_prop_set),
+    "costume": (_RE_PROP_SET, _cmd_prop_set),
+    "move": (_RE_MOVE_CMD, _cmd_move),
+    "show": (_RE_SHOW_CMD, _cmd_show),
+    "hide": (_RE_HIDE_CMD, _cmd_hide),
+}
+
+_GROUP_CMDS = {
+    "x": (_RE_GROUP_PROP_SET, _cmd_group_prop_set),
+    "y": (_RE_GROUP_PROP_SET, _cmd_group_prop_set),
+    "direction": (_RE_GROUP_PROP_SET, _cmd_group_prop_set),
+    "move": (_RE_GROUP_MOVE, _cmd_group_move),
+}
+
+def _dispatch_target(line):
+    h = _RE_LINE_HEAD.match(line)
+    if h is None:
+        return None, None
+    head, member = h.groups()
+    if head.endswith("#*"):
+        cmd = _GROUP_CMDS.get(member)
+    elif member is None:
+        cmd = _HEAD_CMDS.get(head)
+    else:
+        cmd = _STAGE_CMDS.get((head, member)) or _MEMBER_CMDS.get(member)
+    if cmd is not None:
+        m = cmd[0].match(line)
+        if m:
+            return cmd[1], m.groups()
+    if member is None:
+        m = _RE_ASSIGN.match(line)
+        if m:
+            return _cmd_assign, m.groups()
+    return None, None
+
+# 行の 分類 (どの 命令か、どの 関数に どの 引数で 渡すか)。状態に よらないので 行ごとに 覚えておく
+_PLAN_PASS, _PLAN_BLOCK, _PLAN_BRACES, _PLAN_CMD, _PLAN_HOST = range(5)
+_PLAN_MAX = 16384
+# あふれたら 長く 使われていない 行から 捨てる
+_plans = collections.OrderedDict()
+
+def _classify(line):
+    stripped = line.strip()
+    if stripped == "" or stripped.startswith("//") or stripped.startswith("import "):
+        return (_PLAN_PASS,)
+    # touching / pressedは 実行の たびに 値が 変わるので 置き換えた あとで もう一度 分類する
+    dynamic = "touching" in line or "pressed" in line or "released" in line
+    opens = line.count("{")
+    closes = line.count("}")
+    if opens or closes:
+        h = _RE_LINE_HEAD.match(line)
+        cmd = _BLOCK_OPENS.get(h.group(1)) if h else None
+        if cmd is not None:
+            m = cmd[0].match(line)
+            if m:
+                return (_PLAN_BLOCK, dynamic, stripped, opens, closes, cmd[1], m.groups())
+        return (_PLAN_BRACES, dynamic, stripped, opens, closes)
+    fn, groups = _dispatch_target(line)
+    if fn is not None:
+        return (_PLAN_CMD, dynamic, stripped, opens, closes, fn, groups)
+    return (_PLAN_HOST, dynamic, stripped, opens, closes)
+
+def _line_plan(line):
+    plan = _state["program_plans"].get(line)
+    if plan is not None:
+        return plan
+    plan = _plans.get(line)
+    if plan is None:
+        plan = _classify(line)
+        if len(_plans) >= _PLAN_MAX:
+            _plans.popitem(last=False)
+        _plans[line] = plan
+    else:
+        _plans.move_to_end(line)
+    return plan
+
+def _run_plan(line, plan):
+    kind = plan[0]
+    if kind == _PLAN_BLOCK or kind == _PLAN_CMD:
+        if _state["profile"] is not None:
+            out = _profiled(plan[5], line, *plan[6])
+        else:
+            out = plan[5](line, *plan[6])
+        if kind == _PLAN_BLOCK or out is not None:
+            return out
+    elif kind == _PLAN_BRACES:
+        _state["foreign_depth"] += plan[3]
+        for _ in range(plan[4]):
+            if _state["foreign_depth"] > 0:
+                _state["foreign_depth"] -= 1
+            elif _state["block_stack"]:
+                _state["block_stack"].pop()
+        return line
+    elif kind == _PLAN_PASS:
         return line
 
     if not _state["block_stack"]:
@@ -694,3 +2168,222 @@ def process_line(line: str) -> str:
         return ""
 
     return line
+
+@_world_api
+def process_line(line: str) -> str:
+    if type(line) is _CloneLine:
+        plan = line.plan
+        if _state["clone_capture"] is not None:
+            line = str(line)
+            plan = _line_plan(line)
+    else:
+        plan = _line_plan(line)
+    if plan[0] == _PLAN_PASS:
+        return line
+
+    if _state["clone_capture"] is not None:
+        cap = _state["clone_capture"]
+        if plan[2] == "}":
+            cap["depth"] -= 1
+            if cap["depth"] == 0:
+                _finish_clone_capture(cap)
+            else:
+                cap["lines"].append(line)
+            return ""
+        cap["lines"].append(line)
+        cap["depth"] += (plan[3] - plan[4])
+        if cap["depth"] == 0:
+            _finish_clone_capture(cap)
+        return ""
+
+    if plan[1]:
+        if "touching" in line:
+            if _state["profile"] is not None:
+                line = _profiled(_RE_TOUCHING_CALL.sub, _touching_eval_sub, line, name="touching")
+            else:
+                line = _RE_TOUCHING_CALL.sub(_touching_eval_sub, line)
+        if "pressed" in line or "released" in line:
+            if _state["profile"] is not None:
+                line = _profiled(_RE_PRESSED_CALL.sub, _pressed_eval_sub, line, name="pressed")
+            else:
+                line = _RE_PRESSED_CALL.sub(_pressed_eval_sub, line)
+        plan = _line_plan(line)
+
+    return _run_plan(line, plan)
+
+# 行の 分類を ファイルに 保存する ときの 形式 (変えたら 番号を 上げる)
+_PLAN_FILE_VERSION = 1
+_PLAN_HANDLERS = {fn.__name__: fn for table in (_BLOCK_OPENS, _HEAD_CMDS, _STAGE_CMDS, _MEMBER_CMDS, _GROUP_CMDS)
+                  for _, fn in table.values()}
+_PLAN_HANDLERS[_cmd_assign.__name__] = _cmd_assign
+# 先に 解析しておく 数式の 引数の 位置
+_PLAN_EXPR_ARGS = {
+    _cmd_prop_set: (2,),
+    _cmd_move: (1,),
+    _cmd_assign: (1,),
+}
+_PLAN_GROUP_EXPR_ARGS = {
+    _cmd_group_prop_set: 2,
+    _cmd_group_move: 1,
+}
+
+def _warm_plan(plan):
+    if plan[0] != _PLAN_CMD:
+        return
+    fn, groups = plan[5], plan[6]
+    if fn is _cmd_prop_set and groups[1] == "costume":
+        return
+    for i in _PLAN_EXPR_ARGS.get(fn, ()):
+        if _to_string_literal(groups[i]) is None:
+            _compile_number_expr(groups[i])
+    i = _PLAN_GROUP_EXPR_ARGS.get(fn)
+    if i is not None:
+        _compile_group_expr(groups[i], groups[0])
+
+def _plan_to_json(plan):
+    if plan[0] in (_PLAN_BLOCK, _PLAN_CMD):
+        return list(plan[:5]) + [plan[5].__name__, list(plan[6])]
+    return list(plan)
+
+def _plan_from_json(j):
+    kind = j[0]
+    if kind == _PLAN_PASS:
+        return (_PLAN_PASS,)
+    if kind in (_PLAN_BLOCK, _PLAN_CMD):
+        fn = _PLAN_HANDLERS.get(j[5])
+        if fn is None:
+            raise ValueError(j[5])
+        return (kind, bool(j[1]), j[2], int(j[3]), int(j[4]), fn, tuple(j[6]))
+    if kind in (_PLAN_BRACES, _PLAN_HOST):
+        return (kind, bool(j[1]), j[2], int(j[3]), int(j[4]))
+    raise ValueError(kind)
+
+def _front_end():
+    # 言語パック (clage_jp など) が 読み込まれて いれば 同じ 変換を 先に 行う
+    lang = sys.modules.get("clage_lang")
+    if lang is not None and lang.active():
+        return lang
+    return None
+
+def _plan_cache_path(text, lang):
+    d = _state["disk_cache_dir"]
+    if not d:
+        return None
+    h = hashlib.sha1(text.encode("utf-8"))
+    h.update(f"|v{_PLAN_FILE_VERSION}|{lang.signature() if lang else ''}".encode("utf-8"))
+    return os.path.join(d, h.hexdigest() + ".plan.json")
+
+def _load_plans(cpath, lang):
+    try:
+        with open(cpath, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != _PLAN_FILE_VERSION:
+            return None
+        entries = [(src, out, _plan_from_json(j)) for src, out, j in data["lines"]]
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None
+    if lang is not None:
+        lang.seed((src, out) for src, out, _ in entries)
+    return entries
+
+@_world_api
+def compile_program(path_or_text: str) -> int:
+    # プログラム 全体を 先に 変換・分類して、数式も 解析しておく。
+    # disk_cache_dirが あれば ソースの ハッシュごとに 保存し、次回は 読み込むだけに する
+    text = _read_program(path_or_text, "compile")
+    if text is None:
+        return 0
+    lang = _front_end()
+    cpath = _plan_cache_path(text, lang)
+    entries = None
+    if cpath is not None and os.path.exists(cpath):
+        entries = _load_plans(cpath, lang)
+    if entries is None:
+        entries = []
+        plans = {}
+        for src in text.splitlines():
+            out = lang.translate(src) if lang is not None else src
+            plan = plans.get(out)
+            if plan is None:
+                plan = plans[out] = _classify(out)
+            entries.append((src, out, plan))
+        if cpath is not None:
+            data = {"version": _PLAN_FILE_VERSION,
+                    "lines": [[src, out, _plan_to_json(plan)] for src, out, plan in entries]}
+            _disk_write(cpath, [json.dumps(data, ensure_ascii=False).encode("utf-8")])
+    # 捨てずに 残すのは 最後に compileした プログラムの 行だけ
+    _state["program_plans"] = {out: plan for _, out, plan in entries}
+    for _, _, plan in entries:
+        _warm_plan(plan)
+    return len(entries)
+
+@_world_api
+def sprite_states():
+    return {name: {"x": sp.x, "y": sp.y, "direction": sp.direction, "costume": sp.costume,
+                   "visible": sp.visible, "is_clone": sp.is_clone}
+            for name, sp in _state["sprites"].items()}
+
+
+class World:
+    # clageの プログラム 1つ分の インタープリタ。1つの プロセスで いくつも 同時に 動かせる
+    # (モジュールの process_line / tick などは 既定の Worldを 使う)
+    def __init__(self, **options):
+        self.state = _new_state()
+        self.state["owns_pygame"] = False
+        self.state["headless"] = True
+        self.configure(**options)
+
+    def _call(self, fn, *args, **kw):
+        return _run_in(self.state, fn, args, kw)
+
+    def configure(self, **options):
+        self._call(configure, **options)
+
+    def on_import(self):
+        self._call(on_import)
+
+    def process_line(self, line: str) -> str:
+        return self._call(process_line, line)
+
+    def tick(self):
+        _tick_in(self.state)
+
+    def run_frames(self, n: int, on_frame=None) -> int:
+        return self._call(run_frames, n, on_frame)
+
+    def drain_pending_lines(self):
+        return self._call(drain_pending_lines)
+
+    def drain_stats(self):
+        return self._call(drain_stats)
+
+    def image_cache_stats(self):
+        return self._call(image_cache_stats)
+
+    def preload_program(self, path_or_text: str) -> int:
+        return self._call(preload_program, path_or_text)
+
+    def compile_program(self, path_or_text: str) -> int:
+        return self._call(compile_program, path_or_text)
+
+    def prewarm_rotations(self, path: str) -> bool:
+        return self._call(prewarm_rotations, path)
+
+    def sprite_states(self):
+        return self._call(sprite_states)
+
+    def profile_start(self):
+        self._call(profile_start)
+
+    def profile_stop(self):
+        return self._call(profile_stop)
+
+    def profile_stats(self):
+        return self._call(profile_stats)
+
+    @property
+    def running(self) -> bool:
+        return bool(self.state["running"]) and self.state["screen"] is not None
+
+    def close(self):
+        self._call(_close_world)
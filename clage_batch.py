@@ -0,0 +1,146 @@
+import os
+import sys
+import io
+import glob
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import concurrent.futures
+
+# 画面なしで 動かす (clageより 先に 設定しておく)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+_LANGS = ("clage_jp", "clage_kata")
+
+def _collect(directory, pattern):
+    paths = sorted(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+    return [p for p in paths if os.path.isfile(p) and not os.path.basename(p).startswith(".")]
+
+def _run_in_process(path, frames, langs):
+    # 同じ ワーカープロセスの 中で Worldを 作り直して 動かす (pygameの 起動は 1回だけ)。
+    # ホストの コード (if / forever など) は 動かないので、結果は clageの 行だけを 実行した ものに なる
+    import clage
+    for name in langs:
+        __import__(name)
+    translate = None
+    if langs:
+        import clage_lang
+        translate = clage_lang.translate
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        w = clage.World(headless=True, fixed_step=True, max_frames=frames)
+        w.on_import()
+        # clageの 外 (ホスト側の 行) は 実行できないので、clageの 行だけを 流す
+        with open(path, encoding="utf-8") as f:
+            for line in f.read().splitlines():
+                w.process_line(translate(line) if translate else line)
+        while w.running:
+            for line in w.drain_pending_lines():
+                w.process_line(line)
+            w.tick()
+        report = {"frames": w.state["frame"], "sprites": w.sprite_states(),
+                  "globals": dict(w.state["globals"])}
+        w.close()
+    return report, out.getvalue()
+
+def _run_host(path, frames, host, timeout):
+    # ホスト (clambonなど) を 別プロセスで 起動し、clageに 結果を JSONで 書き出させる
+    fd, report_path = tempfile.mkstemp(prefix="clage-report-", suffix=".json")
+    os.close(fd)
+    env = dict(os.environ, CLAGE_HEADLESS="1", CLAGE_FIXED_STEP="1",
+               CLAGE_MAX_FRAMES=str(frames), CLAGE_REPORT=report_path)
+    cmd = [a.format(program=path) for a in shlex.split(host)]
+    try:
+        proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=timeout)
+        report = None
+        try:
+            with open(report_path, encoding="utf-8") as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if proc.returncode != 0:
+            raise RuntimeError(f"exit {proc.returncode}: {proc.stderr.strip()[-2000:]}")
+        if report is None:
+            raise RuntimeError("レポートが 書き出されませんでした")
+        return report, proc.stdout
+    finally:
+        try:
+            os.remove(report_path)
+        except OSError:
+            pass
+
+def run_one(path, frames, host=None, timeout=None, langs=()):
+    t = time.perf_counter()
+    result = {"program": path, "mode": "host" if host else "clage_lines_only", "ok": True, "error": None}
+    try:
+        if host:
+            report, output = _run_host(path, frames, host, timeout)
+        else:
+            report, output = _run_in_process(path, frames, langs)
+        result.update(report)
+        result["output"] = output.splitlines()
+    except subprocess.TimeoutExpired:
+        result.update(ok=False, error=f"timeout ({timeout}s)")
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - t
+    return result
+
+def run_batch(directory, frames=300, pattern="*", workers=None, host=None, timeout=None, langs=(),
+              in_process=False):
+    # ホストなしでは プログラムの 一部しか 動かないので、明示した ときだけ 使う
+    if not host and not in_process:
+        raise ValueError("hostか in_process=Trueを 指定してください")
+    paths = _collect(directory, pattern)
+    workers = workers or os.cpu_count() or 1
+    t = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(run_one, p, frames, host, timeout, tuple(langs)) for p in paths]
+        for job in jobs:
+            results.append(job.result())
+    return {
+        "summary": {
+            "programs": len(results),
+            "ok": sum(r["ok"] for r in results),
+            "failed": sum(not r["ok"] for r in results),
+            "mode": "host" if host else "clage_lines_only",
+            "workers": workers,
+            "frames": frames,
+            "seconds": time.perf_counter() - t,
+        },
+        "programs": results,
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="clage batch runner")
+    ap.add_argument("directory")
+    ap.add_argument("--pattern", default="*", help="プログラムの ファイル名 (glob)")
+    ap.add_argument("--frames", type=int, default=300)
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--host", help='ホストの コマンド。例: "python -m clambon {program}"')
+    ap.add_argument("--in-process", action="store_true",
+                    help="ホストを 使わず clageの 行だけを 実行する (if / foreverなどの ホストの コードは 動かない)")
+    ap.add_argument("--timeout", type=float, default=None)
+    ap.add_argument("--lang", action="append", default=[], choices=_LANGS)
+    ap.add_argument("--out", help="結果の JSONを 書き出す ファイル (省略時は 標準出力)")
+    args = ap.parse_args(argv)
+    if not args.host and not args.in_process:
+        ap.error("--hostか --in-processを 指定してください")
+    report = run_batch(args.directory, args.frames, args.pattern, args.workers, args.host,
+                       args.timeout, args.lang, args.in_process)
+    text = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if report["summary"]["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+# 画面なしで 動かす (clageより 先に 設定しておく)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import clage
+
+_DEFAULTS = {"sprites": 20, "clones": 300, "globals": 50, "lines": 2000, "repeat": 5}
+
+def _best(fn, repeat):
+    # 何回か 測って 一番 速い 値を 使う (ほかの プロセスの 影響を 減らす)
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def _make_costume(tmpdir):
+    path = os.path.join(tmpdir, "bench.png")
+    surf = pygame.Surface((24, 16), pygame.SRCALPHA)
+    surf.fill((0, 0, 0, 0))
+    pygame.draw.ellipse(surf, (200, 60, 60, 255), surf.get_rect())
+    pygame.image.save(surf, path)
+    return path
+
+def _setup(cfg, costume, clones=0):
+    # N個の Sprite、K個の グローバル変数、M個の クローンが ある 状態を 作る
+    clage.configure(headless=True, fixed_step=True, max_frames=None)
+    clage.on_import()
+    clage._state["clock"] = None
+    rng = random.Random(1)
+    lines = ['Stage() {', 'width.set(-400, 400)', 'height.set(-300, 300)', '}']
+    for i in range(cfg["sprites"]):
+        lines += [f'Sprite("S{i}") {{', f'S{i}.costume = "{costume}"',
+                  f'S{i}.x = {rng.randint(-390, 390)}', f'S{i}.y = {rng.randint(-290, 290)}', '}']
+    lines += [f"var g{i} = {rng.randint(1, 100)}" for i in range(cfg["globals"])]
+    lines += ['var arr = [1, 2, 3, 4, 5, 6, 7, 8]']
+    lines += ['Sprite("Enemy") {', f'Enemy.costume = "{costume}"', '}']
+    lines += ["clone(Enemy)"] * clones
+    lines += ['Sprite("Ctx") {']
+    for i in range(1, clones + 1):
+        lines += [f"Enemy#{i}.x = {rng.randint(-390, 390)}", f"Enemy#{i}.y = {rng.randint(-290, 290)}"]
+    for l in lines:
+        clage.process_line(l)
+    return rng
+
+def _expr_lines(cfg, rng):
+    n_spr, n_glob = cfg["sprites"], cfg["globals"]
+    out = []
+    for _ in range(cfg["lines"]):
+        s = rng.randrange(n_spr)
+        g1, g2 = rng.randrange(n_glob), rng.randrange(n_glob)
+        k = rng.randrange(4)
+        if k == 0:
+            out.append(f"S{s}.x = S{s}.x + g{g1} * 0.01 - g{g2} / 100")
+        elif k == 1:
+            out.append(f"S{s}.direction = S{s}.direction + arr[{rng.randrange(8)}]")
+        elif k == 2:
+            out.append(f"g{g1} = (g{g2} + S{s}.y) % 97")
+        else:
+            out.append(f"S{s}.move(g{g1} % 5)")
+    return out
+
+def bench_process_line(cfg, costume):
+    rng = _setup(cfg, costume)
+    lines = _expr_lines(cfg, rng)
+    def run():
+        for l in lines:
+            clage.process_line(l)
+    dt = _best(run, cfg["repeat"])
+    return {"lines": len(lines), "seconds": dt, "lines_per_sec": len(lines) / dt}
+
+def bench_eval_number_expr(cfg, costume):
+    _setup(cfg, costume)
+    exprs = {
+        "literal": "42",
+        "global": "g1",
+        "arith": "(g1 + g2) * 3 - g3 / 7",
+        "sprite": "S0.x + S1.y * 2",
+        "array": "arr[g1 % 8] + arr[2]",
+    }
+    n = 20000
+    out = {}
+    for name, e in exprs.items():
+        clage._eval_number_expr(e)
+        dt = _best(lambda: [clage._eval_number_expr(e) for _ in range(n)], cfg["repeat"])
+        out[name] = {"us_per_call": dt / n * 1e6}
+    # 初めて 見る 式 (解析を 含む)
+    fresh = [f"S{i % cfg['sprites']}.x + {i} * g{i % cfg['globals']}" for i in range(n)]
+    t = time.perf_counter()
+    for e in fresh:
+        clage._eval_number_expr(e)
+    out["first_compile"] = {"us_per_call": (time.perf_counter() - t) / n * 1e6}
+    return out
+
+def bench_touching(cfg, costume):
+    _setup(cfg, costume, clones=cfg["clones"])
+    names = [f"S{i}" for i in range(cfg["sprites"])]
+    queries = [(n, "Enemy") for n in names] + [(n, "edge") for n in names]
+    def run():
+        for a, b in queries:
+            clage._is_touching(a, b)
+    out = {"queries": len(queries), "targets": cfg["clones"]}
+    dt = _best(run, cfg["repeat"])
+    out["rect_us_per_query"] = dt / len(queries) * 1e6
+    dt = _best(lambda: [clage._is_touching(a, b, True) for a, b in queries], cfg["repeat"])
+    out["precise_us_per_query"] = dt / len(queries) * 1e6
+    # 全員が 動いた あとの 問い合わせ (グリッドの 更新を 含む)
+    moves = [f"Enemy#{i}.move(3)" for i in range(1, cfg["clones"] + 1)]
+    def moved():
+        for l in moves:
+            clage.process_line(l)
+        run()
+    dt = _best(moved, cfg["repeat"])
+    out["frame_with_moves_ms"] = dt * 1e3
+    return out
+
+def bench_draw_frame(cfg, costume):
+    _setup(cfg, costume, clones=cfg["clones"])
+    sprites = list(clage._state["sprites"].values())
+    # 毎フレーム 1割の Spriteを 動かす (半分は 移動、半分は 回転)
+    movers = sprites[::10]
+    out = {"visible": len(clage._state["sprite_order"]), "moving": len(movers)}
+    frames = 30
+    step = [0]
+    def move():
+        step[0] += 1
+        for i, sp in enumerate(movers):
+            if i % 2:
+                sp.direction = (sp.direction + 7) % 360
+            else:
+                sp.x += 3 if step[0] % 2 else -3
+    def moving():
+        for _ in range(frames):
+            move()
+            clage._draw_frame()
+    def static():
+        for _ in range(frames):
+            clage._draw_frame()
+    for mode in (False, True):
+        clage.configure(dirty_rects=mode)
+        clage._state["drawn"] = None
+        clage._draw_frame()
+        key = "dirty" if mode else "full"
+        out[f"{key}_ms"] = _best(moving, cfg["repeat"]) / frames * 1e3
+        # 何も 動かない 画面 (差分描画では 何も しない ことが 多い)
+        out[f"static_{key}_ms"] = _best(static, cfg["repeat"]) / frames * 1e3
+    clage.configure(dirty_rects=False)
+    return out
+
+def bench_clones(cfg, costume):
+    _setup(cfg, costume)
+    n = cfg["clones"]
+    script = ['Sprite("Bullet") {', f'Bullet.costume = "{costume}"', 'clone {',
+              'clone.x = clone.x + 1', 'clone.move(2)', '}', '}', 'Sprite("Ctx") {']
+    for l in script:
+        clage.process_line(l)
+    base = [0]
+    def spawn():
+        for _ in range(n):
+            clage.process_line("clone(Bullet)")
+        # ホストと 同じように 溜まった 行を 流す
+        while clage._state["pending_to_clambon"]:
+            for l in clage.drain_pending_lines():
+                clage.process_line(l)
+    def delete():
+        start = base[0]
+        for i in range(start + 1, start + n + 1):
+            clage.process_line(f'__clage_clone_delete__("Bullet#{i}")')
+        base[0] += n
+    spawn_s = delete_s = None
+    for _ in range(cfg["repeat"]):
+        t = time.perf_counter()
+        spawn()
+        dt = time.perf_counter() - t
+        spawn_s = dt if spawn_s is None else min(spawn_s, dt)
+        t = time.perf_counter()
+        delete()
+        dt = time.perf_counter() - t
+        delete_s = dt if delete_s is None else min(delete_s, dt)
+    return {"clones": n, "spawn_per_sec": n / spawn_s, "delete_per_sec": n / delete_s}
+
+BENCHES = {
+    "process_line": bench_process_line,
+    "eval_number_expr": bench_eval_number_expr,
+    "touching": bench_touching,
+    "draw_frame": bench_draw_frame,
+    "clones": bench_clones,
+}
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run(cfg=None, only=None):
+    cfg = dict(_DEFAULTS, **(cfg or {}))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pygame.init()
+        costume = _make_costume(tmpdir)
+        for name, fn in BENCHES.items():
+            if only and name not in only:
+                continue
+            # process_lineの エラー表示などは 結果に 混ぜない
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = fn(cfg, costume)
+    return {
+        "meta": {
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "numpy": clage._numpy() is not None,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "config": cfg,
+        "results": results,
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="clage benchmark")
+    for k, v in _DEFAULTS.items():
+        ap.add_argument(f"--{k}", type=int, default=v)
+    ap.add_argument("--only", action="append", choices=sorted(BENCHES))
+    ap.add_argument("--out", help="結果の JSONを 書き出す ファイル (省略時は 標準出力)")
+    args = ap.parse_args(argv)
+    cfg = {k: getattr(args, k) for k in _DEFAULTS}
+    report = run(cfg, args.only)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
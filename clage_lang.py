@@ -0,0 +1,184 @@
+import re
+import os
+import json
+import hashlib
+import functools
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# 読み込んだ 言語パックを すべて まとめて、1行を 1回の 走査で 英語に 置き換える
+_state = {
+    "packs": {},
+    "keywords": {},
+    "string_keys": [],
+    "clone_words": [],
+    "keyword_re": None,
+    "clone_res": (),
+    # 変換済みの 行。後ろに つながった 別の 言語フロントエンドは そのまま 返す
+    "outputs": {},
+    "max_outputs": 4096,
+    # 前もって 変換しておいた 行 (clage.compile_programの キャッシュから)。最後に 読んだ プログラムの 分だけ 持つ
+    "seeded": {},
+    "signature": None,
+}
+
+_ENV_PACKS = "CLAGE_LANG_PACKS"
+
+def register_pack(name: str, keywords, string_keys=(), clone_words=()):
+    if isinstance(string_keys, dict):
+        string_keys = string_keys.items()
+    _state["packs"][name] = {
+        "keywords": dict(keywords),
+        "string_keys": [(str(src), str(dst)) for src, dst in string_keys],
+        "clone_words": [str(w) for w in clone_words],
+    }
+    _rebuild()
+
+def unregister_pack(name: str):
+    if _state["packs"].pop(name, None) is not None:
+        _rebuild()
+
+def load_pack(path: str, name=None):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == ".toml":
+            if tomllib is None:
+                print(f'言語パックエラー: "{path}" (TOMLを 読むには Python 3.11 以上が 必要です)')
+                return False
+            with open(path, "rb") as f:
+                data = tomllib.load(f)
+        else:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'言語パックエラー: "{path}" を 読み込めません ({e})')
+        return False
+    if not isinstance(data, dict) or not isinstance(data.get("keywords", {}), dict):
+        print(f'言語パックエラー: "{path}" の 形式が 正しく ありません')
+        return False
+    if name is None:
+        name = data.get("name") or os.path.splitext(os.path.basename(path))[0]
+    register_pack(
+        name,
+        data.get("keywords", {}),
+        data.get("string_keys", ()),
+        data.get("clone_words", ()),
+    )
+    return True
+
+def _rebuild():
+    keywords = {}
+    string_keys = []
+    clone_words = []
+    for pack in _state["packs"].values():
+        keywords.update(pack["keywords"])
+        string_keys.extend(pack["string_keys"])
+        for w in pack["clone_words"]:
+            if w not in clone_words:
+                clone_words.append(w)
+    _state["keywords"] = keywords
+    _state["string_keys"] = string_keys
+    _state["clone_words"] = clone_words
+
+    # 文字列を 読み飛ばしながら、辞書の 単語を 長い 順に 1回の 走査で 置き換える
+    if keywords:
+        _state["keyword_re"] = re.compile(
+            r'(".*?"|\'.*?\')|(?<!\w)(?:'
+            + "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+            + r')(?!\w)',
+            re.DOTALL,
+        )
+    else:
+        _state["keyword_re"] = None
+
+    if clone_words:
+        alt = "|".join(re.escape(w) for w in sorted(clone_words, key=len, reverse=True))
+        _state["clone_res"] = (
+            (re.compile(r'^\s*(?:' + alt + r')\s*\{'), 'clone {'),
+            (re.compile(r'(?<!\w)(?:' + alt + r')(?=\.)'), 'clone'),
+            (re.compile(r'(?<!\w)(?:' + alt + r')(?=\s*\()'), 'clone'),
+        )
+    else:
+        _state["clone_res"] = ()
+
+    _state["outputs"].clear()
+    _state["seeded"].clear()
+    _state["signature"] = None
+    _translate.cache_clear()
+
+def _keyword(m):
+    if m.group(1) is not None:
+        return m.group(1)
+    return _state["keywords"][m.group(0)]
+
+# クローンの 行は 同じ 行が 何度も 届くので 変換結果を 覚えておく
+@functools.lru_cache(maxsize=4096)
+def _translate(line: str) -> str:
+    for src, dst in _state["string_keys"]:
+        if src in line:
+            line = line.replace(src, dst)
+
+    for rx, repl in _state["clone_res"]:
+        line = rx.sub(repl, line)
+
+    if _state["keyword_re"] is not None:
+        line = _state["keyword_re"].sub(_keyword, line)
+    return line
+
+def translate(line: str) -> str:
+    stripped = line.strip()
+    if stripped == '' or stripped.startswith('//'):
+        return line
+    outputs = _state["outputs"]
+    if line in outputs:
+        return line
+    out = _state["seeded"].get(line)
+    if out is None:
+        out = _translate(line)
+    if len(outputs) >= _state["max_outputs"]:
+        outputs.clear()
+    outputs[out] = None
+    return out
+
+def active() -> bool:
+    return bool(_state["packs"])
+
+def signature() -> str:
+    # 読み込んでいる パックの 中身から 作る 値。変換結果を キャッシュする ときの キーに 使う
+    if _state["signature"] is None:
+        data = json.dumps([_state["keywords"], _state["string_keys"], _state["clone_words"]],
+                          ensure_ascii=False, sort_keys=True)
+        _state["signature"] = hashlib.sha1(data.encode("utf-8")).hexdigest()
+    return _state["signature"]
+
+def seed(pairs):
+    _state["seeded"] = dict(pairs)
+
+def process_line(line: str) -> str:
+    return translate(line)
+
+def _load_env_packs():
+    for path in os.environ.get(_ENV_PACKS, "").split(os.pathsep):
+        if path.strip():
+            load_pack(path.strip())
+
+def move_to_front(module):
+    # 言語の 変換は ほかの 拡張より 先に 行う
+    try:
+        import sys
+        clambon = sys.modules.get('clambon')
+        if clambon and module:
+            lst = getattr(clambon, 'active_extensions', None)
+            if isinstance(lst, list) and module in lst:
+                lst.remove(module)
+                lst.insert(0, module)
+    except Exception:
+        pass
+
+def on_import():
+    _load_env_packs()
+    import sys
+    move_to_front(sys.modules.get(__name__))